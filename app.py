@@ -1,1315 +1,2091 @@
-import streamlit as st
-from google import genai
-from google.genai import types
-from PIL import Image
-import os
-import time
-import re
-import json
-from datetime import datetime, timedelta, timezone
-from dotenv import load_dotenv
-
-import socket
-import qrcode
-from io import BytesIO
-
-# Google Sheets integration
-import gspread
-
-import requests
-import base64
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import japanize_matplotlib  # 日本語フォント対応
-
-# Load environment variables
-load_dotenv(override=True)
-
-# Google Drive Integration via GAS (Secrets or Env)
-default_gas_url = "https://script.google.com/macros/s/AKfycbxA4FyvHrRwGS9zK6-0PQn4CpGVaJ4vdmXAtttt2jsq9gJG18UBE0MG_j4YM_c6GzdiUw/exec"
-gas_url = st.secrets.get("GAS_SCRIPT_URL", os.getenv("GAS_SCRIPT_URL", default_gas_url))
-
-# Page Config
-# --- Password Protection ---
-# Simple password check
-def check_password():
-    """Returns `True` if the user had the correct password."""
-
-    def password_entered():
-        """Checks whether a password entered by the user is correct."""
-        if st.session_state["password"] == st.secrets.get("APP_PASSWORD", os.getenv("APP_PASSWORD")):
-            st.session_state["password_correct"] = True
-            del st.session_state["password"]  # don't store password
-        else:
-            st.session_state["password_correct"] = False
-
-    # First run, show input
-    if "password_correct" not in st.session_state:
-        st.text_input(
-            "パスワードを入力してください", type="password", on_change=password_entered, key="password"
-        )
-        return False
-    
-    # Password incorrect
-    elif not st.session_state["password_correct"]:
-        st.text_input(
-            "パスワードを入力してください", type="password", on_change=password_entered, key="password"
-        )
-        st.error("😕 パスワードが違います")
-        return False
-    
-    # Password correct
-    else:
-        return True
-
-# Apply the password check
-# Set APP_PASSWORD in .streamlit/secrets.toml (Cloud) or .env (Local)
-# If no password is set in environment, skip check (Development convenience)
-app_password = os.getenv("APP_PASSWORD")
-if app_password: # Only check if password is set environment variable
-    if not check_password():
-        st.stop()
-
-# --- API Key Management ---
-# Try to get API key from environment
-api_key = os.getenv("GOOGLE_API_KEY")
-
-# Only show sidebar input if API key is NOT in environment (Developer mode fallback)
-if not api_key:
-    st.sidebar.warning("APIキーが設定されていません。")
-    api_key = st.sidebar.text_input("Gemini API Key", type="password")
-
-if api_key:
-    api_key = api_key.strip()
-else:
-    st.error("APIキーが見つかりません。.envファイルを設定するか、サイドバーに入力してください。")
-    st.stop()
-
-# Configure Gemini Client (new SDK)
-try:
-    client = genai.Client(api_key=api_key)
-except Exception as e:
-    st.error(f"APIキーの設定に失敗しました: {e}")
-    st.stop()
-
-# --- PDF Reference ---
-@st.cache_resource
-def upload_reference_pdf():
-    pdf_path = "食品成分表.pdf"
-    if os.path.exists(pdf_path):
-        try:
-            # Upload the file to Gemini using new SDK
-            with open(pdf_path, "rb") as f:
-                uploaded_file = client.files.upload(file=f, config={"mime_type": "application/pdf"})
-            return uploaded_file
-        except Exception as e:
-            st.warning(f"参照用PDFのアップロードに失敗しました (推定モードで動作します): {e}")
-            return None
-    return None
-
-# Upload PDF once when app starts (cached)
-pdf_reference = upload_reference_pdf()
-
-# --- Google Sheets Integration ---
-def get_gspread_client():
-    """Googleスプレッドシートクライアントを取得"""
-    try:
-        # Streamlit Secretsからサービスアカウント認証情報を取得
-        credentials_dict = st.secrets.get("gcp_service_account", None)
-        if credentials_dict:
-            gc = gspread.service_account_from_dict(dict(credentials_dict))
-            return gc
-    except Exception as e:
-        st.warning(f"スプレッドシート連携が設定されていません: {e}")
-    return None
-
-def get_or_create_spreadsheet(gc, spreadsheet_name="栄養管理AI"):
-    """スプレッドシートを取得または作成"""
-    try:
-        # 既存のスプレッドシートを開く
-        spreadsheet = gc.open(spreadsheet_name)
-    except gspread.SpreadsheetNotFound:
-        # 存在しない場合は作成
-        spreadsheet = gc.create(spreadsheet_name)
-        # ヘッダー行を追加
-        worksheet = spreadsheet.sheet1
-        worksheet.update('A1:K1', [['日付', '時間', 'ユーザー', '料理名', '食事写真', 'エネルギー(kcal)', 'たんぱく質(g)', '塩分(g)', 'カリウム(mg)', 'リン(mg)', '解析結果全文']])
-    return spreadsheet
-
-# --- Google Drive Integration via GAS ---
-def upload_image_to_gas(image, filename):
-    """画像をGAS経由でGoogle Driveにアップロード"""
-    # 環境変数またはSecretsから取得（取得できない場合はハードコードされた値を使用）
-    default_gas_url = "https://script.google.com/macros/s/AKfycbxA4FyvHrRwGS9zK6-0PQn4CpGVaJ4vdmXAtttt2jsq9gJG18UBE0MG_j4YM_c6GzdiUw/exec"
-    gas_url = st.secrets.get("GAS_SCRIPT_URL", os.getenv("GAS_SCRIPT_URL", default_gas_url))
-    
-    if not gas_url:
-        st.warning("⚠️ GAS_SCRIPT_URLが設定されていません。")
-        return None
-
-    try:
-        # 画像をBase64文字列に変換
-        img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=85)
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-        
-        payload = {
-            'filename': filename,
-            'image_data': img_base64,
-            'folder_name': '食事写真' # GAS側でこのフォルダを探します
-        }
-        
-        response = requests.post(gas_url, json=payload)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('status') == 'success':
-                return result.get('url')
-            else:
-                st.warning(f"GASエラー: {result.get('message')}")
-        else:
-            st.warning(f"GAS通信エラー: {response.status_code}")
-            
-    except Exception as e:
-        st.warning(f"画像アップロード処理でエラー: {e}")
-    
-    return None
-
-def log_to_spreadsheet(gc, nickname, meal_name, nutrition_data, full_text="", image_url=""):
-    """解析結果をスプレッドシートに追記"""
-    try:
-        spreadsheet = get_or_create_spreadsheet(gc)
-        worksheet = spreadsheet.sheet1
-        
-        # 日本時間 (JST) を取得
-        JST = timezone(timedelta(hours=9), 'JST')
-        now = datetime.now(JST)
-        
-        # 画像URLがある場合はIMAGE関数として設定
-        image_formula = f'=IMAGE("{image_url}")' if image_url else ""
-        
-        row = [
-            now.strftime('%Y-%m-%d'),
-            now.strftime('%H:%M:%S'),
-            nickname,
-            meal_name,
-            image_formula,
-            nutrition_data.get('energy', '不明'),
-            nutrition_data.get('protein', '不明'),
-            nutrition_data.get('salt', '不明'),
-            nutrition_data.get('potassium', '不明'),
-            nutrition_data.get('phosphorus', '不明'),
-            full_text
-        ]
-        
-        # append_rowはデフォルトで数式を文字列として扱うので、
-        # value_input_option='USER_ENTERED'を指定して数式として認識させる
-        worksheet.append_row(row, value_input_option='USER_ENTERED')
-        return True
-    except Exception as e:
-        st.warning(f"スプレッドシートへの保存に失敗しました: {e}")
-        return False
-
-def parse_nutrition_from_response(response_text):
-    """AI応答から栄養素を抽出"""
-    nutrition = {}
-    
-    # 料理名を抽出
-    meal_match = re.search(r'料理名[：:]\s*(.+)', response_text)
-    if meal_match:
-        nutrition['meal_name'] = meal_match.group(1).strip()
-    else:
-        nutrition['meal_name'] = '不明'
-    
-    # 各栄養素を抽出 (数値のみ)
-    # より柔軟な正規表現に変更
-    patterns = {
-        'energy': r'エネルギー.*?([\d,\.～~\-]+)',
-        'protein': r'(?:タンパク質|たんぱく質).*?([\d,\.～~\-]+)',
-        'salt': r'塩分.*?([\d,\.～~\-]+)',
-        'potassium': r'カリウム.*?([\d,\.～~\-]+)',
-        'phosphorus': r'リン.*?([\d,\.～~\-]+)'
-    }
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, response_text, re.IGNORECASE)
-        if match and match.group(1):
-            val = match.group(1).replace(',', '').replace('～', '〜').replace('~', '〜')
-            nutrition[key] = val
-        else:
-            nutrition[key] = '不明'
-    
-    return nutrition
-
-# --- 管理者モード用関数 ---
-def get_all_records(gc, spreadsheet_name="栄養管理AI"):
-    """スプレッドシートから全データを取得"""
-    try:
-        spreadsheet = gc.open(spreadsheet_name)
-        worksheet = spreadsheet.sheet1
-        records = worksheet.get_all_records()
-        return records
-    except Exception as e:
-        st.warning(f"データ取得に失敗しました: {e}")
-        return []
-
-def get_existing_nicknames(gc, spreadsheet_name="栄養管理AI"):
-    """スプレッドシートから既存のニックネーム一覧を取得"""
-    try:
-        spreadsheet = gc.open(spreadsheet_name)
-        worksheet = spreadsheet.sheet1
-        records = worksheet.get_all_records()
-        # "名前"列からユニークな値を取得
-        nicknames = set(r.get('名前', '') for r in records if r.get('名前'))
-        return nicknames
-    except Exception as e:
-        # エラー時は空のセットを返す（チェックをスキップ）
-        return set()
-
-def classify_meal_type(time_str):
-    """時刻から食事区分を判定"""
-    try:
-        # HH:MM:SS 形式を想定
-        parts = time_str.split(':')
-        hour = int(parts[0])
-        
-        if 5 <= hour < 10:
-            return "🌅 朝食"
-        elif 10 <= hour < 15:
-            return "☀️ 昼食"
-        elif 15 <= hour < 22:
-            return "🌙 夕食"
-        else:
-            return "🌃 夜食"
-    except:
-        return "❓ 不明"
-
-def parse_nutrition_value(value):
-    """栄養素の値を数値に変換（範囲の場合は中間値）"""
-    try:
-        if isinstance(value, (int, float)):
-            return float(value)
-        value_str = str(value).replace(',', '').replace(' ', '')
-        # 範囲表記（〜、-、~）の場合は中間値を取る
-        for sep in ['〜', '～', '~', '-']:
-            if sep in value_str:
-                parts = value_str.split(sep)
-                nums = [float(p) for p in parts if p]
-                return sum(nums) / len(nums)
-        return float(value_str)
-    except:
-        return 0.0
-
-# --- 今日の累計栄養素表示機能 ---
-def get_today_records(gc, nickname, spreadsheet_name="栄養管理AI"):
-    """今日のデータをニックネームで抽出"""
-    try:
-        spreadsheet = gc.open(spreadsheet_name)
-        worksheet = spreadsheet.sheet1
-        records = worksheet.get_all_records()
-        
-        # 日本時間の今日の日付を取得
-        JST = timezone(timedelta(hours=9), 'JST')
-        today_str = datetime.now(JST).strftime('%Y-%m-%d')
-        
-        # ニックネームと今日の日付でフィルタ
-        today_records = [
-            r for r in records 
-            if r.get('名前') == nickname and r.get('日付') == today_str
-        ]
-        return today_records
-    except Exception as e:
-        return []
-
-def calculate_daily_totals(records):
-    """累計値を計算"""
-    totals = {
-        'energy': 0.0,
-        'protein': 0.0,
-        'salt': 0.0,
-        'potassium': 0.0,
-        'phosphorus': 0.0,
-        'meal_count': len(records)
-    }
-    
-    for record in records:
-        totals['energy'] += parse_nutrition_value(record.get('エネルギー(kcal)', 0))
-        totals['protein'] += parse_nutrition_value(record.get('たんぱく質(g)', 0))
-        totals['salt'] += parse_nutrition_value(record.get('塩分(g)', 0))
-        totals['potassium'] += parse_nutrition_value(record.get('カリウム(mg)', 0))
-        totals['phosphorus'] += parse_nutrition_value(record.get('リン(mg)', 0))
-    
-    return totals
-
-def get_nutrition_targets(user_weight=None):
-    """目標値を取得（体重設定済みの場合は個人目標）"""
-    if user_weight:
-        # 体重ベースの目標値（中央値を使用）
-        return {
-            'energy': user_weight * 32.5,  # 30-35の中央
-            'protein': user_weight * 1.05,  # 0.9-1.2の中央
-            'salt': 6.0,
-            'potassium': 2000.0,
-            'phosphorus': user_weight * 1.05 * 15  # たんぱく質 × 15
-        }
-    else:
-        # 一般的な目安値（60kg想定）
-        return {
-            'energy': 1950.0,  # 60kg × 32.5
-            'protein': 63.0,   # 60kg × 1.05
-            'salt': 6.0,
-            'potassium': 2000.0,
-            'phosphorus': 945.0  # 63 × 15
-        }
-
-def display_nutrition_progress(totals, targets):
-    """プログレスバー付きで累計を表示"""
-    # カスタムCSSでプログレスバーの色を制御
-    st.markdown("""
-    <style>
-    .nutrition-item {
-        margin-bottom: 15px;
-        padding: 10px;
-        background: #f8f9fa;
-        border-radius: 8px;
-    }
-    .nutrition-label {
-        display: flex;
-        justify-content: space-between;
-        margin-bottom: 5px;
-        font-weight: bold;
-    }
-    .progress-bar {
-        height: 20px;
-        background: #e9ecef;
-        border-radius: 10px;
-        overflow: hidden;
-    }
-    .progress-fill {
-        height: 100%;
-        border-radius: 10px;
-        transition: width 0.3s ease;
-    }
-    .progress-good { background: linear-gradient(90deg, #4CAF50, #8BC34A); }
-    .progress-warning { background: linear-gradient(90deg, #FF9800, #FFC107); }
-    .progress-danger { background: linear-gradient(90deg, #f44336, #E91E63); }
-    .status-text {
-        font-size: 0.9em;
-        margin-top: 3px;
-    }
-    .over-limit {
-        color: #C62828;
-        font-weight: bold;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # 各栄養素の表示設定
-    nutrients = [
-        ('energy', '🔥 エネルギー', 'kcal', totals['energy'], targets['energy']),
-        ('protein', '🥩 たんぱく質', 'g', totals['protein'], targets['protein']),
-        ('salt', '🧂 塩分', 'g', totals['salt'], targets['salt']),
-        ('potassium', '🍌 カリウム', 'mg', totals['potassium'], targets['potassium']),
-        ('phosphorus', '🦴 リン', 'mg', totals['phosphorus'], targets['phosphorus']),
-    ]
-    
-    for key, label, unit, current, target in nutrients:
-        percentage = min((current / target) * 100, 150) if target > 0 else 0
-        display_pct = min(percentage, 100)  # バーは100%まで
-        
-        # 色の決定
-        if percentage >= 100:
-            color_class = 'progress-danger'
-            status = '⚠️ 超過'
-        elif percentage >= 80:
-            color_class = 'progress-warning'
-            status = '注意'
-        else:
-            color_class = 'progress-good'
-            status = '良好'
-        
-        # 表示
-        over_class = 'over-limit' if percentage >= 100 else ''
-        st.markdown(f"""
-        <div class="nutrition-item">
-            <div class="nutrition-label">
-                <span>{label}</span>
-                <span class="{over_class}">{current:.1f} / {target:.0f} {unit} ({percentage:.0f}%)</span>
-            </div>
-            <div class="progress-bar">
-                <div class="progress-fill {color_class}" style="width: {display_pct}%;"></div>
-            </div>
-            <div class="status-text {over_class}">{status}</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # 食事回数
-    st.markdown(f"**📝 本日の記録: {totals['meal_count']}食**")
-
-def create_nutrition_chart(df, start_date=None, end_date=None):
-    """栄養推移グラフを作成（全栄養素対応・3段構成）"""
-    # japanize_matplotlibによりフォント設定は不要
-    
-    # 日付をdatetime型に変換
-    dates = [datetime.strptime(d, '%Y-%m-%d') for d in df['日付']]
-    
-    # 3段のグラフを作成
-    fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(10, 10), sharex=True)
-    
-    # --- 1段目: エネルギー ---
-    ax1.plot(dates, df['エネルギー(kcal)'], marker='o', label='エネルギー(kcal)', color='#FF9800', linewidth=2)
-    ax1.set_ylabel('エネルギー (kcal)')
-    ax1.legend(loc='upper left')
-    ax1.grid(True, linestyle='--', alpha=0.7)
-    ax1.set_title('日ごとの栄養摂取推移')
-    
-    # --- 2段目: タンパク質・塩分 (2軸) ---
-    ax2.plot(dates, df['たんぱく質(g)'], marker='s', label='たんぱく質(g)', color='#4CAF50', linewidth=2)
-    ax2.set_ylabel('たんぱく質 (g)')
-    ax2.legend(loc='upper left')
-    ax2.grid(True, linestyle='--', alpha=0.7)
-    
-    # 塩分を右軸で表示
-    ax2_right = ax2.twinx()
-    ax2_right.plot(dates, df['塩分(g)'], marker='^', label='塩分(g)', color='#F44336', linestyle='--', linewidth=2)
-    ax2_right.set_ylabel('塩分 (g)')
-    ax2_right.legend(loc='upper right')
-    
-    # --- 3段目: カリウム・リン ---
-    ax3.plot(dates, df['カリウム(mg)'], marker='v', label='カリウム(mg)', color='#9C27B0', linewidth=2)
-    ax3.plot(dates, df['リン(mg)'], marker='d', label='リン(mg)', color='#3F51B5', linewidth=2)
-    ax3.set_ylabel('ミネラル (mg)')
-    ax3.legend(loc='upper left')
-    ax3.grid(True, linestyle='--', alpha=0.7)
-    
-    # X軸のフォーマット
-    ax3.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
-    
-    # 期間指定がある場合はX軸の範囲を固定
-    if start_date and end_date:
-        # datetime型に変換して範囲を設定
-        start_dt = datetime.combine(start_date, datetime.min.time())
-        end_dt = datetime.combine(end_date, datetime.min.time())
-        ax3.set_xlim([start_dt, end_dt])
-    
-    plt.tight_layout()
-    return fig
-
-def generate_html_report(user_name, start_date, end_date, summary_data, records, chart_fig, doctor_comment):
-    """印刷用HTMLレポートを生成（全項目対応・印刷ボタン付き）"""
-    
-    # グラフをBase64に変換
-    img_buf = BytesIO()
-    chart_fig.savefig(img_buf, format='png', dpi=100)
-    img_buf.seek(0)
-    chart_b64 = base64.b64encode(img_buf.read()).decode('utf-8')
-    plt.close(chart_fig)
-    
-    # レポート行の生成
-    rows_html = ""
-    for r in records:
-        # 画像URL取得
-        img_src = ""
-        image_cell = r.get('料理写真', '')
-        if image_cell and '=IMAGE(' in str(image_cell):
-            match = re.search(r'=IMAGE\("([^"]+)"\)', str(image_cell))
-            if match:
-                img_src = match.group(1)
-        elif image_cell and str(image_cell).startswith('http'):
-            img_src = image_cell
-            
-        img_tag = f'<img src="{img_src}" class="meal-img">' if img_src else '<span class="no-img">画像なし</span>'
-        
-        rows_html += f"""
-        <tr>
-            <td style="width: 100px;">
-                <div class="date">{r.get('日付', '')}</div>
-                <div class="meal-type">{r.get('食事区分', '')}</div>
-                <small>{r.get('時刻', '')}</small>
-            </td>
-            <td class="img-cell" style="width: 120px;">{img_tag}</td>
-            <td>
-                <div class="dish-name">{r.get('料理名', '不明')}</div>
-                <div class="nutrition-grid">
-                    <span class="badge energy">E: {r.get('エネルギー(kcal)', 0)}</span>
-                    <span class="badge protein">P: {r.get('たんぱく質(g)', 0)}</span>
-                    <span class="badge salt">塩: {r.get('塩分(g)', 0)}</span>
-                    <span class="badge mineral">K: {r.get('カリウム(mg)', 0)}</span>
-                    <span class="badge mineral">P: {r.get('リン(mg)', 0)}</span>
-                </div>
-            </td>
-        </tr>
-        """
-        
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>栄養指導レポート</title>
-        <style>
-            @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;700&display=swap');
-            body {{ font-family: 'Noto Sans JP', sans-serif; color: #333; max-width: 210mm; margin: 0 auto; padding: 20px; background: white; }}
-            
-            /* 印刷ボタン */
-            .print-btn-container {{ position: fixed; top: 20px; right: 20px; z-index: 100; }}
-            .print-btn {{ background: #2196F3; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; font-weight: bold; font-size: 16px; box-shadow: 0 2px 5px rgba(0,0,0,0.2); }}
-            .print-btn:hover {{ background: #1976D2; }}
-            
-            .header {{ display: flex; justify-content: space-between; border-bottom: 2px solid #4CAF50; padding-bottom: 10px; margin-bottom: 20px; }}
-            .title {{ font-size: 24px; font-weight: bold; color: #2E7D32; }}
-            .meta {{ text-align: right; font-size: 14px; line-height: 1.5; }}
-            
-            .section {{ margin-bottom: 25px; border: 1px solid #ddd; padding: 15px; border-radius: 8px; page-break-inside: avoid; }}
-            .section-title {{ font-size: 18px; font-weight: bold; border-left: 5px solid #FF9800; padding-left: 10px; margin-bottom: 15px; background: #FFF3E0; padding: 5px 10px; }}
-            
-            /* サマリー */
-            .summary-table {{ width: 100%; border-collapse: collapse; margin-bottom: 10px; }}
-            .summary-table th {{ background: #f5f5f5; padding: 8px; border: 1px solid #ddd; font-size: 12px; }}
-            .summary-table td {{ padding: 10px; border: 1px solid #ddd; text-align: center; font-weight: bold; font-size: 16px; }}
-            
-            .comment-box {{ background: #E8F5E9; padding: 15px; border-radius: 5px; white-space: pre-wrap; min-height: 60px; }}
-            
-            .chart-container {{ text-align: center; margin: 10px 0; }}
-            .chart-img {{ max-width: 100%; height: auto; border: 1px solid #eee; }}
-            
-            /* 食事記録テーブル */
-            table.records {{ width: 100%; border-collapse: collapse; font-size: 14px; }}
-            table.records td {{ border-bottom: 1px solid #eee; padding: 10px; vertical-align: middle; }}
-            .date {{ font-weight: bold; }}
-            .meal-type {{ font-size: 12px; color: #666; background: #eee; display: inline-block; padding: 2px 6px; border-radius: 4px; margin: 2px 0; }}
-            .dish-name {{ font-weight: bold; font-size: 16px; margin-bottom: 5px; }}
-            .meal-img {{ width: 100px; height: 100px; object-fit: cover; border-radius: 5px; border: 1px solid #ddd; }}
-            .no-img {{ display: inline-block; width: 100px; height: 100px; background: #f5f5f5; line-height: 100px; text-align: center; color: #ccc; font-size: 12px; border-radius: 5px; }}
-            
-            .nutrition-grid {{ display: flex; flex-wrap: wrap; gap: 5px; }}
-            .badge {{ display: inline-block; padding: 2px 8px; border-radius: 12px; font-size: 12px; font-family: monospace; }}
-            .badge.energy {{ background: #FFF3E0; color: #EF6C00; border: 1px solid #FFE0B2; }}
-            .badge.protein {{ background: #E8F5E9; color: #2E7D32; border: 1px solid #C8E6C9; }}
-            .badge.salt {{ background: #FFEBEE; color: #C62828; border: 1px solid #FFCDD2; font-weight: bold; }}
-            .badge.mineral {{ background: #F3E5F5; color: #6A1B9A; border: 1px solid #E1BEE7; }}
-            
-            @media print {{
-                .no-print, .print-btn-container {{ display: none !important; }}
-                body {{ padding: 0; background: white; }}
-                .section {{ border: none; padding: 0; margin-bottom: 20px; }}
-                .chart-img {{ max-width: 100%; max-height: 500px; }}
-                tr {{ page-break-inside: avoid; }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="print-btn-container">
-            <button class="print-btn" onclick="window.print()">🖨️ 印刷する</button>
-        </div>
-
-        <div class="header">
-            <div>
-                <div class="title">栄養指導レポート</div>
-                <div style="margin-top:10px; font-size: 18px;">患者様: <strong>{user_name} 様</strong></div>
-            </div>
-            <div class="meta">
-                作成日: {datetime.now().strftime('%Y/%m/%d')}<br>
-                対象期間: {start_date} 〜 {end_date}
-            </div>
-        </div>
-
-        <div class="section">
-            <div class="section-title">📊 期間サマリー (1日平均)</div>
-            <table class="summary-table">
-                <thead>
-                    <tr>
-                        <th>エネルギー</th>
-                        <th>たんぱく質</th>
-                        <th>塩分</th>
-                        <th>カリウム</th>
-                        <th>リン</th>
-                        <th>記録日数</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    <tr>
-                        <td>{summary_data['avg_energy']} kcal</td>
-                        <td>{summary_data['avg_protein']} g</td>
-                        <td style="color: #C62828;">{summary_data['avg_salt']} g</td>
-                        <td>{summary_data['avg_potassium']} mg</td>
-                        <td>{summary_data['avg_phosphorus']} mg</td>
-                        <td>{summary_data['day_count']} 日</td>
-                    </tr>
-                </tbody>
-            </table>
-        </div>
-        
-        <div class="section">
-            <div class="section-title">👨‍⚕️ 栄養指導コメント</div>
-            <div class="comment-box">{doctor_comment if doctor_comment else "（コメントなし）"}</div>
-        </div>
-
-        <div class="section">
-            <div class="section-title">📈 栄養摂取推移</div>
-            <div class="chart-container">
-                <img src="data:image/png;base64,{chart_b64}" class="chart-img">
-            </div>
-        </div>
-
-        <div class="section">
-            <div class="section-title">🍽️ 食事記録詳細</div>
-            <table class="records">
-                {rows_html}
-            </table>
-        </div>
-    </body>
-    </html>
-    """
-    return html
-
-# Custom CSS for styling
-st.markdown("""
-<style>
-    .reportview-container {
-        background: #f0f2f6;
-    }
-    .main-header {
-        font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif;
-        color: #333;
-        text-align: center;
-        padding: 1rem 0;
-        font-size: clamp(1.2rem, 5vw, 2.5rem); /* フォントサイズを少し控えめに */
-        word-break: keep-all; /* 単語の途中での改行を防ぐ */
-        overflow-wrap: break-word;
-    }
-    .stButton>button {
-        width: 100%;
-        background-color: #ff4b4b;
-        color: white;
-        border-radius: 10px;
-        height: 3em;
-        font-weight: bold;
-    }
-    .result-card {
-        background-color: white;
-        padding: 20px;
-        border-radius: 15px;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-        margin-top: 20px;
-    }
-    .disclaimer {
-        font-size: 0.8em;
-        color: #666;
-        margin-top: 30px;
-        border-top: 1px solid #ddd;
-        padding-top: 10px;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-st.markdown("<h1 class='main-header'>透析 栄養管理AIアプリ 🥗</h1>", unsafe_allow_html=True)
-st.markdown("<p style='text-align: center;'>食事の写真を撮るorアップロードするだけで、透析管理に必要な栄養素をAIが瞬時に解析します。</p>", unsafe_allow_html=True)
-
-# Status indicator
-if pdf_reference:
-    st.markdown("✅ **食品成分表データロード済み**: 高精度モードで動作中")
-else:
-    st.caption("ℹ️ 標準モードで動作中 (成分表PDF未検出)")
-
-
-# --- Nickname Section (with Local Storage) ---
-st.markdown("---")
-
-# Initialize gspread client
-gc = get_gspread_client()
-if gc:
-    st.markdown("✅ **スプレッドシート連携**: 有効")
-else:
-    st.caption("ℹ️ スプレッドシート連携が未設定です（結果はローカル表示のみ）")
-
-# --- Nickname Section (URLパラメータ方式) ---
-# URLから nickname パラメータを取得
-query_params = st.query_params
-url_nickname = query_params.get("nickname", None)
-
-# Initialize session state
-if 'nickname' not in st.session_state:
-    st.session_state.nickname = None
-
-# URLパラメータからニックネームを設定
-if url_nickname and not st.session_state.nickname:
-    st.session_state.nickname = url_nickname
-
-# Display nickname or input form
-if st.session_state.nickname:
-    col_nick1, col_nick2 = st.columns([3, 1])
-    with col_nick1:
-        st.markdown(f"👋 こんにちは、**{st.session_state.nickname}** さん")
-    with col_nick2:
-        if st.button("名前を変更", key="change_nickname"):
-            st.session_state.nickname = None
-            # URLパラメータをクリア
-            st.query_params.clear()
-            st.rerun()
-else:
-    st.markdown("### 👤 ニックネームを設定してください")
-    st.caption("解析結果を記録するために使用します（本名でなくてOK）")
-    st.caption("💡 設定後、表示されるURLをブックマークすると次回から自動ログインできます")
-    
-    with st.form("nickname_form"):
-        new_nickname = st.text_input("ニックネーム", placeholder="例: 田中さん")
-        submitted = st.form_submit_button("設定")
-        
-        if submitted and new_nickname:
-            # スプレッドシートで重複チェック
-            existing_nicknames = get_existing_nicknames(gc) if gc else set()
-            
-            if new_nickname in existing_nicknames:
-                st.error(f"❌ 「{new_nickname}」は既に使用されています。別のニックネームを入力してください。")
-            else:
-                st.session_state.nickname = new_nickname
-                # URLパラメータに追加（これでURLが更新される）
-                st.query_params["nickname"] = new_nickname
-                st.rerun()
-
-# --- 今日の記録確認ボタン ---
-if st.session_state.nickname and gc:
-    if st.button("📊 今日の記録を確認", key="check_today", use_container_width=True):
-        st.session_state.show_today_summary = not st.session_state.get('show_today_summary', False)
-    
-    if st.session_state.get('show_today_summary', False):
-        with st.container():
-            st.markdown("### 📊 今日の累計栄養素")
-            
-            # 今日のデータを取得
-            with st.spinner("データを読み込み中..."):
-                today_records = get_today_records(gc, st.session_state.nickname)
-            
-            if today_records:
-                # 累計を計算
-                totals = calculate_daily_totals(today_records)
-                
-                # 目標値を取得（体重設定済みの場合は個人目標）
-                targets = get_nutrition_targets(st.session_state.get('user_weight', None))
-                
-                # 体重が設定されていない場合は案内を表示
-                if not st.session_state.get('user_weight'):
-                    st.info("💡 下の「体重換算で個人目安を計算」で体重を設定すると、より正確な目標値が表示されます。")
-                
-                # プログレスバー付きで表示
-                display_nutrition_progress(totals, targets)
-                
-                # 詳細な内訳を表示
-                with st.expander("📝 本日の食事詳細"):
-                    for i, record in enumerate(today_records, 1):
-                        meal_type = classify_meal_type(record.get('時刻', ''))
-                        st.markdown(f"**{i}. {record.get('料理名', '不明')}** ({meal_type})")
-                        st.caption(f"時刻: {record.get('時刻', '')} | E: {record.get('エネルギー(kcal)', 0)}kcal, P: {record.get('たんぱく質(g)', 0)}g, 塩: {record.get('塩分(g)', 0)}g")
-            else:
-                st.info("📭 今日の記録はまだありません。食事を撮影して記録しましょう！")
-            
-            st.markdown("---")
-
-# --- サイドバー: 管理者機能 ---
-with st.sidebar:
-    st.subheader("📊 管理者機能")
-    
-    # セッションステートで管理者モードを管理
-    if 'admin_mode' not in st.session_state:
-        st.session_state.admin_mode = False
-    if 'admin_authenticated' not in st.session_state:
-        st.session_state.admin_authenticated = False
-    
-    # 管理者パスワード（secrets.tomlから取得、未設定時は管理者機能を無効化）
-    admin_password = st.secrets.get("ADMIN_PASSWORD", None)
-    
-    if not admin_password:
-        st.caption("管理者機能は無効です")
-    elif st.session_state.admin_mode:
-        if st.button("🏠 通常モードに戻る", key="exit_admin"):
-            st.session_state.admin_mode = False
-            st.session_state.admin_authenticated = False
-            st.rerun()
-    else:
-        # パスワード入力フォーム
-        if not st.session_state.admin_authenticated:
-            admin_pw_input = st.text_input("🔐 管理者パスワード", type="password", key="admin_pw")
-            if st.button("📊 管理者モードを開く", key="enter_admin"):
-                if admin_pw_input == admin_password:
-                    st.session_state.admin_authenticated = True
-                    st.session_state.admin_mode = True
-                    st.rerun()
-                else:
-                    st.error("❌ パスワードが違います")
-
-# --- メインコンテンツ分岐 ---
-if st.session_state.get('admin_mode', False):
-    # ========== 管理者モード ==========
-    st.markdown("---")
-    st.markdown("## 📊 食事記録レポート（管理者モード）")
-    
-    if not gc:
-        st.error("⚠️ スプレッドシート連携が設定されていないため、管理者モードは使用できません。")
-    else:
-        # データ取得
-        with st.spinner("データを読み込み中..."):
-            all_records = get_all_records(gc)
-        
-        if not all_records:
-            st.warning("📭 スプレッドシートにデータがまだありません。")
-        else:
-            # ユーザー一覧を取得
-            users = list(set([r.get('名前', '') for r in all_records if r.get('名前')]))
-            users.sort()
-            
-            # --- フィルタUI ---
-            st.markdown("### 🔍 検索条件")
-            col_filter1, col_filter2, col_filter3 = st.columns(3)
-            
-            with col_filter1:
-                selected_user = st.selectbox("👤 ユーザー", ["全員"] + users)
-            
-            with col_filter2:
-                # 日付範囲（デフォルトは過去30日）
-                from datetime import date
-                today = date.today()
-                default_start = today - timedelta(days=30)
-                start_date = st.date_input("📅 開始日", default_start)
-            
-            with col_filter3:
-                end_date = st.date_input("📅 終了日", today)
-            
-            # --- データフィルタリング ---
-            filtered_records = []
-            for record in all_records:
-                # 日付フィルタ
-                try:
-                    record_date_str = record.get('日付', '')
-                    if record_date_str:
-                        record_date = datetime.strptime(record_date_str, '%Y-%m-%d').date()
-                        if not (start_date <= record_date <= end_date):
-                            continue
-                except:
-                    continue
-                
-                # ユーザーフィルタ
-                if selected_user != "全員":
-                    if record.get('名前') != selected_user:
-                        continue
-                
-                # 食事区分を追加
-                time_str = record.get('時刻', '')
-                record['食事区分'] = classify_meal_type(time_str)
-                
-                filtered_records.append(record)
-            
-            # 日付・時刻でソート
-            filtered_records.sort(key=lambda x: (x.get('日付', ''), x.get('時刻', '')))
-            
-            st.markdown(f"**{len(filtered_records)}件** のデータが見つかりました")
-            
-            if filtered_records:
-                # --- 期間サマリー ---
-                st.markdown("### 📈 期間サマリー")
-                
-                # 栄養素の集計
-                total_energy = sum(parse_nutrition_value(r.get('エネルギー(kcal)', 0)) for r in filtered_records)
-                total_protein = sum(parse_nutrition_value(r.get('たんぱく質(g)', 0)) for r in filtered_records)
-                total_salt = sum(parse_nutrition_value(r.get('塩分(g)', 0)) for r in filtered_records)
-                total_potassium = sum(parse_nutrition_value(r.get('カリウム(mg)', 0)) for r in filtered_records)
-                total_phosphorus = sum(parse_nutrition_value(r.get('リン(mg)', 0)) for r in filtered_records)
-                
-                meal_count = len(filtered_records)
-                
-                # 日数を計算
-                unique_dates = set(r.get('日付') for r in filtered_records if r.get('日付'))
-                day_count = len(unique_dates) if unique_dates else 1
-                
-                col_sum1, col_sum2, col_sum3 = st.columns(3)
-                
-                with col_sum1:
-                    st.metric("総食事回数", f"{meal_count}回")
-                    st.metric("記録日数", f"{day_count}日")
-                
-                with col_sum2:
-                    st.metric("平均エネルギー/食", f"{total_energy/meal_count:.0f} kcal" if meal_count else "0 kcal")
-                    st.metric("平均たんぱく質/食", f"{total_protein/meal_count:.1f} g" if meal_count else "0 g")
-                    st.metric("平均塩分/食", f"{total_salt/meal_count:.1f} g" if meal_count else "0 g")
-                
-                with col_sum3:
-                    st.metric("1日平均エネルギー", f"{total_energy/day_count:.0f} kcal" if day_count else "0 kcal")
-                    st.metric("1日平均たんぱく質", f"{total_protein/day_count:.1f} g" if day_count else "0 g")
-                    st.metric("1日平均塩分", f"{total_salt/day_count:.1f} g" if day_count else "0 g")
-                
-                # --- グラフ表示 ---
-                st.markdown("### 📊 日ごとの推移")
-                
-                # 日ごとの集計
-                daily_data = {}
-                for record in filtered_records:
-                    date_key = record.get('日付', '')
-                    if date_key not in daily_data:
-                        daily_data[date_key] = {'energy': 0, 'protein': 0, 'salt': 0, 'potassium': 0, 'phosphorus': 0}
-                    daily_data[date_key]['energy'] += parse_nutrition_value(record.get('エネルギー(kcal)', 0))
-                    daily_data[date_key]['protein'] += parse_nutrition_value(record.get('たんぱく質(g)', 0))
-                    daily_data[date_key]['salt'] += parse_nutrition_value(record.get('塩分(g)', 0))
-                    daily_data[date_key]['potassium'] += parse_nutrition_value(record.get('カリウム(mg)', 0))
-                    daily_data[date_key]['phosphorus'] += parse_nutrition_value(record.get('リン(mg)', 0))
-                
-                if daily_data:
-                    import pandas as pd
-                    chart_df = pd.DataFrame([
-                        {'日付': k, 
-                         'エネルギー(kcal)': v['energy'], 
-                         'たんぱく質(g)': v['protein'], 
-                         '塩分(g)': v['salt'],
-                         'カリウム(mg)': v.get('potassium', 0), # 既存データのためにget
-                         'リン(mg)': v.get('phosphorus', 0)}      # 既存データのためにget
-                        for k, v in sorted(daily_data.items())
-                    ])
-                    
-                    # Streamlitでの表示もmatplotlibを使用（統一のため）
-                    fig = create_nutrition_chart(chart_df, start_date, end_date)
-                    st.pyplot(fig)
-                
-                # --- 食事記録一覧 ---
-                st.markdown("### 🍽️ 食事記録一覧")
-                
-                for record in filtered_records:
-                    with st.expander(f"{record.get('日付', '')} {record.get('食事区分', '')} - {record.get('料理名', '不明')}"):
-                        col_img, col_info = st.columns([1, 2])
-                        
-                        with col_img:
-                            # 画像表示（IMAGE関数からURLを抽出）
-                            image_cell = record.get('料理写真', '')
-                            if image_cell and '=IMAGE(' in str(image_cell):
-                                # =IMAGE("URL") からURLを抽出
-                                url_match = re.search(r'=IMAGE\("([^"]+)"\)', str(image_cell))
-                                if url_match:
-                                    st.image(url_match.group(1), width=150)
-                            elif image_cell and image_cell.startswith('http'):
-                                st.image(image_cell, width=150)
-                            else:
-                                st.caption("📷 画像なし")
-                        
-                        with col_info:
-                            st.markdown(f"**ユーザー**: {record.get('名前', '不明')}")
-                            st.markdown(f"**時刻**: {record.get('時刻', '不明')}")
-                            st.markdown(f"**エネルギー**: {record.get('エネルギー(kcal)', '不明')} kcal")
-                            st.markdown(f"**たんぱく質**: {record.get('たんぱく質(g)', '不明')} g")
-                            st.markdown(f"**塩分**: {record.get('塩分(g)', '不明')} g")
-                            st.markdown(f"**カリウム**: {record.get('カリウム(mg)', '不明')} mg")
-                            st.markdown(f"**リン**: {record.get('リン(mg)', '不明')} mg")
-                
-                # --- レポート作成 ---
-                st.markdown("---")
-                st.markdown("### 🖨️ 印刷用レポート")
-                
-                with st.form("report_form"):
-                    doctor_comment = st.text_area("👨‍⚕️ 栄養指導コメント", height=100, placeholder="ここに患者様へのアドバイスを入力してください")
-                    submitted = st.form_submit_button("📄 レポートをプレビュー生成")
-                    
-                if submitted:
-                    if not daily_data:
-                        st.error("データがないためレポートを作成できません")
-                    else:
-                        # サマリーデータの作成
-                        summary_data = {
-                            'avg_energy': f"{total_energy/meal_count:.0f}" if meal_count else "0",
-                            'avg_protein': f"{total_protein/meal_count:.1f}" if meal_count else "0",
-                            'avg_salt': f"{total_salt/meal_count:.1f}" if meal_count else "0",
-                            'avg_potassium': f"{total_potassium/meal_count:.0f}" if meal_count else "0",
-                            'avg_phosphorus': f"{total_phosphorus/meal_count:.0f}" if meal_count else "0",
-                            'day_count': str(day_count)
-                        }
-                        
-                        # グラフの再作成
-                        chart_fig = create_nutrition_chart(chart_df, start_date, end_date)
-                        
-                        # HTML生成
-                        report_html = generate_html_report(
-                            user_name=selected_user if selected_user != "全員" else "患者",
-                            start_date=start_date.strftime('%Y/%m/%d'),
-                            end_date=end_date.strftime('%Y/%m/%d'),
-                            summary_data=summary_data,
-                            records=filtered_records,
-                            chart_fig=chart_fig,
-                            doctor_comment=doctor_comment
-                        )
-                        
-                        st.markdown("### 📄 レポートプレビュー")
-                        st.info("以下のエリアの内容が印刷されます。ブラウザの印刷機能（Ctrl+P / Cmd+P）を使用してください。")
-                        
-                        # HTMLを表示（高さは適当に確保）
-                        st.components.v1.html(report_html, height=1200, scrolling=True)
-    
-    # 管理者モードの場合は通常モードを表示しない
-    st.stop()
-
-# --- Nutritional Guidelines Section ---
-st.markdown("### 📊 透析患者の1日栄養摂取目安")
-
-# Initialize session state for weight
-if 'user_weight' not in st.session_state:
-    st.session_state.user_weight = None
-
-# Display guidelines in a nice format
-col_guide1, col_guide2 = st.columns(2)
-
-with col_guide1:
-    st.markdown("""
-    | 栄養素 | 目安値 |
-    |--------|--------|
-    | **エネルギー** | 30〜35 kcal/kg/日 |
-    | **たんぱく質** | 0.9〜1.2 g/kg/日 |
-    | **食塩** | 6g 未満 |
-    """)
-
-with col_guide2:
-    st.markdown("""
-    | 栄養素 | 目安値 |
-    |--------|--------|
-    | **カリウム** | 2000mg 未満 |
-    | **リン** | たんぱく質(g) × 15 以下 |
-    """)
-
-# Weight calculator
-if st.button("🧮 体重換算で個人目安を計算"):
-    st.session_state.show_weight_form = True
-
-if st.session_state.get('show_weight_form', False):
-    with st.form("weight_form"):
-        st.markdown("#### あなたの体重を入力してください")
-        weight_input = st.number_input("体重 (kg)", min_value=20.0, max_value=200.0, value=60.0, step=0.5)
-        submitted = st.form_submit_button("計算")
-        
-        if submitted:
-            st.session_state.user_weight = weight_input
-            st.session_state.show_weight_form = False
-            st.rerun()
-
-# Display personalized guidelines if weight is set
-if st.session_state.user_weight:
-    weight = st.session_state.user_weight
-    
-    # Calculate personalized values
-    energy_min = weight * 30
-    energy_max = weight * 35
-    protein_min = weight * 0.9
-    protein_max = weight * 1.2
-    phosphorus_max = protein_max * 15
-    
-    st.success(f"👤 **あなたの体重 ({weight}kg) に基づく1日の目安**")
-    
-    st.markdown(f"""
-    | 栄養素 | あなたの目安値 |
-    |--------|---------------|
-    | **エネルギー** | {energy_min:.0f} 〜 {energy_max:.0f} kcal |
-    | **たんぱく質** | {protein_min:.1f} 〜 {protein_max:.1f} g |
-    | **食塩** | 6g 未満 |
-    | **カリウム** | 2000mg 未満 |
-    | **リン** | {phosphorus_max:.0f}mg 以下 |
-    """)
-    
-    if st.button("🔄 体重をリセット"):
-        st.session_state.user_weight = None
-        st.rerun()
-
-st.markdown("---")
-
-# ========== 通常モード（食事入力） ==========
-# Input Method
-st.write("---")
-input_method = st.radio("入力方法", ["カメラで撮影", "画像をアップロード"], horizontal=True, label_visibility="collapsed")
-
-image = None
-
-col1, col2 = st.columns([1, 2])
-
-with col1:
-    if input_method == "カメラで撮影":
-        img_file_buffer = st.camera_input("食事を撮影")
-        if img_file_buffer:
-            try:
-                image = Image.open(img_file_buffer)
-            except Exception as e:
-                st.error(f"画像の読み込みに失敗しました: {e}")
-    else:
-        uploaded_file = st.file_uploader("画像を選択", type=["jpg", "jpeg", "png"])
-        if uploaded_file:
-            try:
-                image = Image.open(uploaded_file)
-            except Exception as e:
-                st.error(f"ファイルを開けませんでした。破損しているか、対応していない形式の可能性があります: {e}")
-
-with col2:
-    if image:
-        st.image(image, caption="解析対象の画像", width='stretch', use_column_width=True)
-        
-        # st.write("") # Spacer
-        if st.button("栄養解析を開始"):
-            # Variables to store result outside status block
-            response = None
-            last_error = None
-            model_name = 'gemini-2.5-flash'  # gemini-3-flash doesn't exist yet
-            
-            # Use st.status for a better progression UI
-            with st.status("🚀 解析プロセス起動...", expanded=True) as status:
-                try:
-                    # Simulation of scanning
-                    status.write("🔍 画像データをスキャン中...")
-                    progress_bar = status.progress(0)
-                    for i in range(100):
-                        time.sleep(0.01) # fast scan effect
-                        progress_bar.progress(i + 1)
-                    
-                    status.write("🧬 食材と栄養成分を特定中...")
-                    
-                    # Construct Prompt with Web Search instructions
-                    prompt_text = """
-                    あなたは透析患者の食事管理を支援する専門の栄養士AIです。
-                    渡された食事の画像を解析し、以下の情報を日本語で出力してください。
-
-                    【重要：情報ソースの優先順位】
-                    1. **添付の「食品成分表」PDF**: 記述があれば最優先で使用してください。
-                    2. **Google検索**: コンビニ商品、チェーン店メニューなど、PDFにない商品は積極的にWeb検索で栄養成分を探してください。
-                    3. **推定**: 上記で見つからない場合は、あなたの知識に基づいて推定してください。
-
-                    出力フォーマット:
-                    ## 料理名: [推定される料理名]
-                    (※参照元: 成分表PDF / Web検索 / 推定 のいずれかを記載)
-                    
-                    ## 推定栄養素 (1食あたり)
-                    - **エネルギー**: [数値] kcal
-                    - **タンパク質**: [数値] g
-                    - **塩分相当量**: [数値] g
-                    - **カリウム**: [数値] mg
-                    - **リン**: [数値] mg
-                    - **水分量**: [数値] ml (推定)
-
-                    ## 透析患者へのアドバイス
-                    [この食事における注意点や、透析患者が食べる際のアドバイスを簡潔に]
-                    """
-                    
-                    # Prepare content list
-                    contents = [prompt_text, image]
-                    if pdf_reference:
-                        contents.append(pdf_reference)
-
-                    # Call the model with Google Search enabled
-                    status.write(f"🤖 AIモデル ({model_name}) に接続中...")
-                    status.write("🌐 Google検索を有効化...")
-                    
-                    # Generate content with Google Search tool using new SDK (non-streaming for stability)
-                    response = client.models.generate_content(
-                        model=model_name,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            tools=[types.Tool(google_search=types.GoogleSearch())]
-                        )
-                    )
-                    
-                    status.update(label="✅ 解析完了！", state="complete", expanded=False)
-                    
-                except Exception as e:
-                    last_error = e
-                    status.update(label="❌ エラー発生", state="error", expanded=False)
-            
-            # Display result OUTSIDE of st.status so it shows immediately
-            if response:
-                st.balloons()
-                st.markdown('<div class="result-card">', unsafe_allow_html=True)
-                
-                try:
-                    # Try to get text from response
-                    result_text = None
-                    
-                    # Method 1: Direct text attribute
-                    if hasattr(response, 'text') and response.text:
-                        result_text = response.text
-                    # Method 2: Access via candidates
-                    elif hasattr(response, 'candidates') and response.candidates:
-                        for candidate in response.candidates:
-                            if hasattr(candidate, 'content') and candidate.content:
-                                # partsがNoneでないことを確認
-                                if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                                    for part in candidate.content.parts:
-                                        if hasattr(part, 'text') and part.text:
-                                            result_text = (result_text or "") + part.text
-                    
-                    # Method 3: Extract from grounding_metadata (new SDK with Google Search)
-                    if not result_text and hasattr(response, 'candidates') and response.candidates:
-                        candidate = response.candidates[0]
-                        if hasattr(candidate, 'grounding_metadata') and candidate.grounding_metadata:
-                            gm = candidate.grounding_metadata
-                            if hasattr(gm, 'grounding_supports') and gm.grounding_supports:
-                                # Collect all text segments
-                                segments = []
-                                for support in gm.grounding_supports:
-                                    if hasattr(support, 'segment') and support.segment:
-                                        if hasattr(support.segment, 'text') and support.segment.text:
-                                            segments.append(support.segment.text)
-                                if segments:
-                                    result_text = "\n".join(segments)
-                    
-                    if result_text:
-                        st.markdown(result_text)
-                        
-                        # --- Log to Google Spreadsheet ---
-                        if gc and st.session_state.nickname:
-                            nutrition_data = parse_nutrition_from_response(result_text)
-                            meal_name = nutrition_data.get('meal_name', '不明')
-                            
-                            # Debug: Show parsed data
-                            with st.expander("🔍 解析データデバッグ（開発用）", expanded=False):
-                                st.write("抽出されたデータ:", nutrition_data)
-                                st.write("解析テキスト全文:", result_text)
-                            
-                            # --- 画像をGoogle Driveにアップロード (GAS経由) ---
-                            image_url = ""
-                            
-                            # ファイル名を生成（日時 + ユーザー名 + 料理名）
-                            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                            safe_meal_name = re.sub(r'[\\/*?:"<>|]', '', meal_name)[:20]
-                            filename = f"{timestamp}_{st.session_state.nickname}_{safe_meal_name}.jpg"
-                            
-                            with st.spinner("📸 画像をGoogle Driveに保存中..."):
-                                image_url = upload_image_to_gas(image, filename)
-                            
-                            if image_url:
-                                st.success("📸 食事写真をGoogle Driveに保存しました！")
-                            
-                            if log_to_spreadsheet(gc, st.session_state.nickname, meal_name, nutrition_data, full_text=result_text, image_url=image_url):
-                                st.success("📊 結果をスプレッドシートに保存しました！（全文も記録しました）")
-                            else:
-                                st.info("📊 結果のスプレッドシート保存をスキップしました")
-                        elif not st.session_state.nickname:
-                            st.info("💡 ニックネームを設定すると、結果がスプレッドシートに保存されます")
-                    else:
-                        st.warning("AIからの応答がありませんでした。")
-                        st.write("**デバッグ情報:**")
-                        st.write(f"Response type: {type(response)}")
-                        st.write(f"Response: {response}")
-                        
-                except Exception as display_err:
-                    st.error(f"結果の表示中にエラーが発生しました: {display_err}")
-                    st.write(f"**Response object:** {response}")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
-                
-            elif last_error:
-                st.error("⚠️ 解析に失敗しました")
-                
-                # Friendly Error Handling
-                err_msg = str(last_error)
-                if "429" in err_msg or "ResourceExhausted" in err_msg:
-                    st.warning("短時間に多くのリクエストを送ったため、一時的に利用が制限されています。1〜2分待ってから再試行してください。")
-                elif "404" in err_msg or "NotFound" in err_msg:
-                    st.warning(f"モデル `{model_name}` が見つかりませんでした。APIキーが正しいか確認してください。")
-                else:
-                    st.error(f"エラー詳細: {last_error}")
-
-# Disclaimer
-st.markdown("""
-<div class="disclaimer">
-    <strong>【免責事項】</strong><br>
-    本アプリによる解析結果はAIによる推定値であり、実際の栄養成分と異なる場合があります。<br>
-    あくまで日々の目安としてご利用いただき、厳密な栄養管理については医師や管理栄養士の指導に従ってください。
-</div>
-""", unsafe_allow_html=True)
+import streamlit as st
+from google import genai
+from google.genai import types
+from PIL import Image
+import os
+import time
+import re
+import hmac
+import random
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+import socket
+from io import BytesIO
+
+import requests
+import base64
+
+# 画像のbase64化はSIMD実装のpybase64があればそちらを使う
+# （1MB級のJPEGエンコードで標準実装の数倍速い。無ければ標準にフォールバック）
+try:
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
+
+# JSONシリアライズもRust実装のorjsonがあれば使う（数MBのbase64文字列を
+# 含むGASペイロードで標準jsonより数倍速い）
+try:
+    import orjson
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# Load environment variables
+load_dotenv(override=True)
+
+# Google Drive Integration via GAS (Secrets or Env)
+default_gas_url = "https://script.google.com/macros/s/AKfycbxA4FyvHrRwGS9zK6-0PQn4CpGVaJ4vdmXAtttt2jsq9gJG18UBE0MG_j4YM_c6GzdiUw/exec"
+gas_url = st.secrets.get("GAS_SCRIPT_URL", os.getenv("GAS_SCRIPT_URL", default_gas_url))
+
+# Page Config
+# --- Password Protection ---
+# パスワードは起動時に一度だけ読む（リランごとのsecrets/環境変数参照を排除）
+_APP_PASSWORD = st.secrets.get("APP_PASSWORD", os.getenv("APP_PASSWORD"))
+
+
+# Simple password check
+def check_password():
+    """Returns `True` if the user had the correct password."""
+
+    def password_entered():
+        """Checks whether a password entered by the user is correct."""
+        # compare_digestでタイミング差による総当たりヒントを与えない
+        # （str同士だと非ASCII文字でTypeErrorになるためbytesで比較する）
+        if hmac.compare_digest(
+            st.session_state["password"].encode("utf-8"),
+            _APP_PASSWORD.encode("utf-8"),
+        ):
+            st.session_state["password_correct"] = True
+            del st.session_state["password"]  # don't store password
+        else:
+            st.session_state["password_correct"] = False
+
+    # First run, show input
+    if "password_correct" not in st.session_state:
+        st.text_input(
+            "パスワードを入力してください", type="password", on_change=password_entered, key="password"
+        )
+        return False
+    
+    # Password incorrect
+    elif not st.session_state["password_correct"]:
+        st.text_input(
+            "パスワードを入力してください", type="password", on_change=password_entered, key="password"
+        )
+        st.error("😕 パスワードが違います")
+        return False
+    
+    # Password correct
+    else:
+        return True
+
+# Apply the password check
+# Set APP_PASSWORD in .streamlit/secrets.toml (Cloud) or .env (Local)
+# If no password is set in environment, skip check (Development convenience)
+if _APP_PASSWORD: # Only check if password is set
+    if not check_password():
+        st.stop()
+
+# --- API Key Management ---
+# Try to get API key from environment
+api_key = os.getenv("GOOGLE_API_KEY")
+
+# Only show sidebar input if API key is NOT in environment (Developer mode fallback)
+if not api_key:
+    st.sidebar.warning("APIキーが設定されていません。")
+    api_key = st.sidebar.text_input("Gemini API Key", type="password")
+
+if api_key:
+    api_key = api_key.strip()
+else:
+    st.error("APIキーが見つかりません。.envファイルを設定するか、サイドバーに入力してください。")
+    st.stop()
+
+# Configure Gemini Client (new SDK)
+@st.cache_resource
+def get_client(key):
+    """Geminiクライアントを生成し、接続をウォームアップして返す"""
+    c = genai.Client(api_key=key)
+    try:
+        # 軽いAPI呼び出しでTLS/HTTP2接続を張っておき、
+        # 初回の解析リクエストからハンドシェイクRTTを除く
+        next(iter(c.models.list()), None)
+    except Exception:
+        pass  # ウォームアップ失敗は無視（本呼び出し時に接続される）
+    return c
+
+try:
+    client = get_client(api_key)
+except Exception as e:
+    st.error(f"APIキーの設定に失敗しました: {e}")
+    st.stop()
+
+MODEL_NAME = 'gemini-2.5-flash'  # gemini-3-flash doesn't exist yet
+
+# Construct Prompt with Web Search instructions
+PROMPT_TEXT = """
+あなたは透析患者の食事管理を支援する専門の栄養士AIです。
+渡された食事の画像を解析し、以下の情報を日本語で出力してください。
+
+【重要：情報ソースの優先順位】
+1. **添付の「食品成分表」PDF**: 記述があれば最優先で使用してください。
+2. **Google検索**: コンビニ商品、チェーン店メニューなど、PDFにない商品は積極的にWeb検索で栄養成分を探してください。
+3. **推定**: 上記で見つからない場合は、あなたの知識に基づいて推定してください。
+
+出力フォーマット:
+## 料理名: [推定される料理名]
+(※参照元: 成分表PDF / Web検索 / 推定 のいずれかを記載)
+
+## 推定栄養素 (1食あたり)
+- **エネルギー**: [数値] kcal
+- **タンパク質**: [数値] g
+- **塩分相当量**: [数値] g
+- **カリウム**: [数値] mg
+- **リン**: [数値] mg
+- **水分量**: [数値] ml (推定)
+
+## 透析患者へのアドバイス
+[この食事における注意点や、透析患者が食べる際のアドバイスを簡潔に]
+"""
+
+# --- PDF Reference ---
+# 再起動のたびに数MBのPDFを再アップロードしないよう、GeminiのファイルIDを保存しておく
+PDF_FILE_ID_PATH = ".streamlit/pdf_file_id.txt"
+
+@st.cache_resource
+def upload_reference_pdf():
+    pdf_path = "食品成分表.pdf"
+    if not os.path.exists(pdf_path):
+        return None
+
+    # 前回アップロード分のファイルIDが残っていればそれを再利用
+    try:
+        with open(PDF_FILE_ID_PATH) as f:
+            stored_name = f.read().strip()
+        if stored_name:
+            uploaded_file = client.files.get(name=stored_name)
+            if "ACTIVE" in str(getattr(uploaded_file, "state", "")):
+                return uploaded_file
+    except Exception:
+        pass  # 未保存・期限切れ・削除済みなら次の手段へフォールバック
+
+    # ローカルのID控えが無い環境（再デプロイ直後など）でも、内容ダイジェストを
+    # display_nameに埋めてあるのでfiles.list()から既存アップロードを探せる
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+    display_name = f"food-table-{hashlib.sha256(pdf_bytes).hexdigest()[:16]}"
+    try:
+        for remote in client.files.list():
+            if (getattr(remote, "display_name", None) == display_name
+                    and "ACTIVE" in str(getattr(remote, "state", ""))):
+                return remote
+    except Exception:
+        pass
+
+    try:
+        # Upload the file to Gemini using new SDK
+        uploaded_file = client.files.upload(
+            file=BytesIO(pdf_bytes),
+            config={"mime_type": "application/pdf", "display_name": display_name},
+        )
+        try:
+            os.makedirs(os.path.dirname(PDF_FILE_ID_PATH), exist_ok=True)
+            with open(PDF_FILE_ID_PATH, "w") as f:
+                f.write(uploaded_file.name)
+        except OSError:
+            pass  # 書き込めない環境でも動作に支障はない
+        return uploaded_file
+    except Exception as e:
+        st.warning(f"参照用PDFのアップロードに失敗しました (推定モードで動作します): {e}")
+        return None
+
+# Upload PDF once when app starts (cached)
+pdf_reference = upload_reference_pdf()
+
+@st.cache_resource(ttl=3000)
+def get_pdf_cache():
+    """食品成分表PDFをGeminiのコンテキストキャッシュに登録
+
+    キャッシュ済みトークンは再エンコード不要のため、毎回PDFを添付するより
+    安く・速くなる。TTL(3600s)切れ前にst.cache_resource側(ttl=3000)で再作成する。
+    """
+    if not pdf_reference:
+        return None
+    try:
+        return client.caches.create(
+            model=MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                contents=[pdf_reference],
+                tools=[types.Tool(google_search=types.GoogleSearch())],
+                ttl="3600s"
+            )
+        )
+    except Exception as e:
+        st.warning(f"コンテキストキャッシュの作成に失敗しました (PDFを直接添付します): {e}")
+        return None
+
+pdf_cache = get_pdf_cache()
+
+# 生成設定はロード時に一度だけ組み立てる（ツール・ティア指定は解析ごとに
+# 変わらないので、ホットパスで毎回オブジェクトを作り直す必要がない）
+# Priority tier: interactive path, so request the low-latency queue.
+# (The API auto-downgrades to standard when priority quota is exhausted.)
+try:
+    if pdf_cache:
+        # ツールはキャッシュ作成時に登録済みのため再指定しない
+        _GEMINI_CFG = types.GenerateContentConfig(
+            cached_content=pdf_cache.name,
+            service_tier="priority"
+        )
+    else:
+        _GEMINI_CFG = types.GenerateContentConfig(
+            tools=[types.Tool(google_search=types.GoogleSearch())],
+            service_tier="priority"
+        )
+except Exception:
+    # Older SDK without service_tier support
+    if pdf_cache:
+        try:
+            # service_tierなしでもコンテキストキャッシュは維持する
+            _GEMINI_CFG = types.GenerateContentConfig(
+                cached_content=pdf_cache.name
+            )
+        except Exception:
+            # cached_contentも使えないSDKならPDF直接添付パスに切り替える
+            pdf_cache = None
+    if not pdf_cache:
+        _GEMINI_CFG = types.GenerateContentConfig(
+            tools=[types.Tool(google_search=types.GoogleSearch())]
+        )
+
+@st.cache_resource
+def get_executor():
+    """バックグラウンドI/O用の共有スレッドプール"""
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def analyze_meal_image(image_bytes, prompt, use_pdf):
+    """食事画像をGeminiで解析し、応答テキストを返す
+
+    画像バイト列＋プロンプトがキャッシュキーになるため、同じ写真の
+    再解析（リトライ・再アップロード時）はAPIを呼ばずに即座に返る。
+    """
+    contents = [prompt, types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")]
+    if use_pdf and pdf_reference and not pdf_cache:
+        # キャッシュ未作成時のみPDFを直接添付
+        contents.append(pdf_reference)
+
+    # ストリーミングで受信し、プレースホルダへ逐次描画する。
+    # 描画はチャンクごとではなく約80msごとにまとめてフラッシュ
+    # （毎トークンのmarkdown再レンダリングとDOM差分を削減）
+    placeholder = st.empty()
+    parts = []
+    append = parts.append  # ローカル束縛でループ内の属性解決を省く
+    last_flush = time.monotonic()
+    response = None  # 最終チャンク（テキストが空だった場合のフォールバック用）
+    # リクエスト送信（接続確立〜先頭バイト待ち）はワーカースレッドに逃がし、
+    # スクリプトスレッドはイテレータを受け取るまで解放する
+    stream_future = get_executor().submit(
+        client.models.generate_content_stream,
+        model=MODEL_NAME,
+        contents=contents,
+        config=_GEMINI_CFG
+    )
+    for chunk in stream_future.result():
+        response = chunk
+        t = getattr(chunk, "text", None)
+        if not t:
+            continue
+        append(t)
+        now = time.monotonic()
+        if now - last_flush > 0.08:
+            placeholder.markdown("".join(parts) + "▌")
+            last_flush = now
+    placeholder.empty()
+
+    full_response = "".join(parts)
+    if full_response:
+        return full_response
+
+    # Fallback: ストリームからテキストが取れなかった場合は最終チャンクの
+    # candidates→content.partsを一度だけ走査する（.textが空ならpartsも空で、
+    # grounding_metadataからの復元が必要なケースは現SDKでは発生しない）
+    segments = []
+    for candidate in (getattr(response, "candidates", None) or []):
+        content = getattr(candidate, "content", None)
+        for part in (getattr(content, "parts", None) or []):
+            if getattr(part, "text", None):
+                segments.append(part.text)
+
+    return "".join(segments)
+
+# --- バッチ解析 (Gemini Batch API) ---
+def submit_batch_analysis(images):
+    """複数画像をGemini Batch APIへ投入し、ジョブ名を返す
+
+    Batch APIは通常の50%のトークン単価でレート制限も別枠のため、
+    撮りためた食事写真をまとめて解析する用途に向く（結果は非同期）。
+    """
+    import tempfile
+
+    lines = []
+    for i, img in enumerate(images):
+        resized = img.copy()
+        resized.thumbnail((1024, 1024), Image.LANCZOS)
+        buf = BytesIO()
+        resized.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+        lines.append(json.dumps({
+            "key": f"meal_{i}",
+            "request": {
+                "contents": [{
+                    "parts": [
+                        {"text": PROMPT_TEXT},
+                        {"inline_data": {
+                            "mime_type": "image/jpeg",
+                            "data": _b64.b64encode(buf.getvalue()).decode('ascii')
+                        }}
+                    ]
+                }]
+            }
+        }, ensure_ascii=False))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as f:
+        f.write("\n".join(lines))
+        jsonl_path = f.name
+
+    try:
+        uploaded = client.files.upload(
+            file=jsonl_path, config={"mime_type": "application/jsonl"}
+        )
+    finally:
+        os.unlink(jsonl_path)
+    batch_job = client.batches.create(
+        model=MODEL_NAME, src={"file_name": uploaded.name}
+    )
+    return batch_job.name
+
+def render_batch_results(job):
+    """完了したバッチジョブの解析結果を表示"""
+    raw = client.files.download(file=job.dest.file_name)
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        try:
+            text = item["response"]["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            text = "（この画像の解析結果を取得できませんでした）"
+        st.markdown(f"#### 📷 {item.get('key', '')}")
+        st.markdown(text)
+        st.markdown("---")
+
+# --- Google Sheets Integration ---
+@st.cache_resource
+def get_gspread_client():
+    """Googleスプレッドシートクライアントを取得（認証はプロセスにつき一度だけ）"""
+    # gspreadはインポートが重いので初回呼び出しまで遅延させる
+    # （cache_resourceなのでプロセスにつき一度しか通らない）
+    import gspread
+
+    try:
+        # Streamlit Secretsからサービスアカウント認証情報を取得
+        credentials_dict = st.secrets.get("gcp_service_account", None)
+        if credentials_dict:
+            gc = gspread.service_account_from_dict(dict(credentials_dict))
+            # Sheets APIへの接続を使い回す（毎回のTLSハンドシェイクを回避し、
+            # 一時的な接続エラーはurllib3側でリトライ）
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4, pool_maxsize=8, max_retries=2
+            )
+            gc.http_client.session.mount("https://", adapter)
+            return gc
+    except Exception as e:
+        st.warning(f"スプレッドシート連携が設定されていません: {e}")
+    return None
+
+def get_or_create_spreadsheet(gc, spreadsheet_name="栄養管理AI"):
+    """スプレッドシートを取得または作成"""
+    import gspread  # 例外型の参照のみ（本体はクライアント生成時にロード済み）
+
+    try:
+        # 既存のスプレッドシートを開く
+        spreadsheet = gc.open(spreadsheet_name)
+    except gspread.SpreadsheetNotFound:
+        # 存在しない場合は作成
+        spreadsheet = gc.create(spreadsheet_name)
+        # ヘッダー行を追加
+        worksheet = spreadsheet.sheet1
+        worksheet.update('A1:K1', [['日付', '時間', 'ユーザー', '料理名', '食事写真', 'エネルギー(kcal)', 'たんぱく質(g)', '塩分(g)', 'カリウム(mg)', 'リン(mg)', '解析結果全文']])
+    return spreadsheet
+
+@st.cache_resource
+def get_worksheet(spreadsheet_name="栄養管理AI"):
+    """sheet1ハンドルを取得（リランごとのopen()ラウンドトリップを回避）"""
+    gc = get_gspread_client()
+    if gc is None:
+        return None
+    return get_or_create_spreadsheet(gc, spreadsheet_name).sheet1
+
+# --- Google Drive Integration via GAS ---
+# GAS向けPOSTは単一セッションを使い回す。keep-aliveで毎回のTLSハンドシェイク
+# （script.google.comへは数百ms）を省き、接続エラーはアダプタ側で再試行する
+_HTTP = requests.Session()
+_HTTP.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=2),
+)
+
+
+def upload_image_to_gas(image_bytes, filename):
+    """JPEGバイト列をGAS経由でGoogle Driveにアップロード
+
+    呼び出し側でGemini用に縮小・再エンコード済みのバイト列をそのまま
+    受け取る（ここで再度リサイズ・エンコードしない）。
+    """
+    # 環境変数またはSecretsから取得（取得できない場合はハードコードされた値を使用）
+    default_gas_url = "https://script.google.com/macros/s/AKfycbxA4FyvHrRwGS9zK6-0PQn4CpGVaJ4vdmXAtttt2jsq9gJG18UBE0MG_j4YM_c6GzdiUw/exec"
+    gas_url = st.secrets.get("GAS_SCRIPT_URL", os.getenv("GAS_SCRIPT_URL", default_gas_url))
+    
+    if not gas_url:
+        st.warning("⚠️ GAS_SCRIPT_URLが設定されていません。")
+        return None
+
+    try:
+        img_base64 = _b64.b64encode(image_bytes).decode('ascii')
+
+        payload = {
+            'filename': filename,
+            'image_data': img_base64,
+            'folder_name': '食事写真' # GAS側でこのフォルダを探します
+        }
+        
+        # GASは一時的な500/接続エラーを返すことがあるため、指数バックオフ＋
+        # ジッタで最大3回まで再試行する（4xxは再試行しても無駄なので即断念）
+        last_error = None
+        for attempt in range(3):
+            if attempt:
+                time.sleep((2 ** attempt) * 0.5 + random.uniform(0, 0.5))
+            try:
+                response = _HTTP.post(
+                    gas_url,
+                    data=_json_dumps(payload),
+                    headers={'Content-Type': 'application/json'},
+                    timeout=30,
+                )
+            except Exception as e:
+                last_error = f"画像アップロード処理でエラー: {e}"
+                continue
+
+            if response.status_code == 200:
+                result = response.json()
+                if result.get('status') == 'success':
+                    return result.get('url')
+                last_error = f"GASエラー: {result.get('message')}"
+                break  # アプリケーションエラーは再送しても結果は同じ
+            last_error = f"GAS通信エラー: {response.status_code}"
+            if response.status_code < 500:
+                break
+
+        if last_error:
+            st.warning(last_error)
+
+    except Exception as e:
+        st.warning(f"画像アップロード処理でエラー: {e}")
+
+    return None
+
+# 行はいったんバッファし、append_rows 1回のAPI呼び出しでまとめて送信する。
+# ただし1食だけ記録してセッションを閉じる利用が大半なので、ログのたびに
+# 非同期フラッシュを起動し、行を未送信のまま残さない（バッファが束ねるのは
+# 同一リラン内の複数書き込みと、失敗でバッファへ戻された行だけ）
+def flush_sheet_buffer(wait=False):
+    """バッファ済みの行をappend_rowsで一括書き込み
+
+    書き込みはワーカースレッドへ投げて楽観的にTrueを返し、リランを
+    ブロックしない。結果は次のリランの_reap_flush_futures()で回収し、
+    失敗した行はバッファへ戻す。読み出し前など完了保証が必要な場合は
+    wait=Trueで同期する。
+    """
+    buffer = st.session_state.get('sheet_buffer', [])
+    if not buffer:
+        return _reap_flush_futures(wait=wait)
+    try:
+        worksheet = get_worksheet()
+        if worksheet is None:
+            return False
+        rows = list(buffer)
+        buffer.clear()
+        future = get_executor().submit(
+            worksheet.append_rows, rows, value_input_option='USER_ENTERED'
+        )
+        st.session_state.setdefault('pending_flushes', []).append((future, rows))
+        if wait:
+            return _reap_flush_futures(wait=True)
+        return True
+    except Exception as e:
+        st.warning(f"スプレッドシートへの保存に失敗しました: {e}")
+        return False
+
+
+def _reap_flush_futures(wait=False):
+    """投げっぱなしの書き込みFutureを回収し、失敗した行をバッファへ戻す"""
+    pending = st.session_state.get('pending_flushes', [])
+    if not pending:
+        return True
+    ok = True
+    wrote = False
+    remaining = []
+    for future, rows in pending:
+        if not wait and not future.done():
+            remaining.append((future, rows))
+            continue
+        try:
+            future.result()
+            wrote = True
+        except Exception as e:
+            ok = False
+            st.warning(f"スプレッドシートへの保存に失敗しました（再保存できます）: {e}")
+            st.session_state.setdefault('sheet_buffer', []).extend(rows)
+    pending[:] = remaining
+    if wrote:
+        # 書き込みが通ったのでTTL切れを待たずキャッシュ済み読み出しを無効化
+        _cached_records.clear()
+        _user_list.clear()
+    return ok
+
+# 解析全文セルの圧縮マーカー（この接頭辞が付くセルはgzip+base64済み）
+_FULLTEXT_MARKER = 'gz:'
+
+
+def _pack_full_text(text):
+    """解析全文をgzip+base64圧縮してセル格納用の文字列にする
+
+    全文は数KBのmarkdownで、圧縮すると転送量とセル消費が1/3程度になる。
+    短い本文はヘッダ分だけ逆に膨らむため、そのまま格納する。
+    """
+    if not text or len(text) < 512:
+        return text
+    packed = _FULLTEXT_MARKER + base64.b64encode(
+        gzip.compress(text.encode('utf-8'))
+    ).decode('ascii')
+    return packed if len(packed) < len(text) else text
+
+
+def _unpack_full_text(cell):
+    """_pack_full_textの逆変換（非圧縮の既存セルはそのまま返す）"""
+    if isinstance(cell, str) and cell.startswith(_FULLTEXT_MARKER):
+        try:
+            return gzip.decompress(
+                base64.b64decode(cell[len(_FULLTEXT_MARKER):])
+            ).decode('utf-8')
+        except Exception:
+            return cell
+    return cell
+
+
+def log_to_spreadsheet(gc, nickname, meal_name, nutrition_data, full_text="", image_url=""):
+    """解析結果をスプレッドシートに追記（バッファして一括書き込み）"""
+    try:
+        # 日本時間 (JST) を取得
+        JST = timezone(timedelta(hours=9), 'JST')
+        now = datetime.now(JST)
+        
+        # 画像URLがある場合はIMAGE関数として設定
+        image_formula = f'=IMAGE("{image_url}")' if image_url else ""
+        
+        row = [
+            now.strftime('%Y-%m-%d'),
+            now.strftime('%H:%M:%S'),
+            nickname,
+            meal_name,
+            image_formula,
+            nutrition_data.get('energy', '不明'),
+            nutrition_data.get('protein', '不明'),
+            nutrition_data.get('salt', '不明'),
+            nutrition_data.get('potassium', '不明'),
+            nutrition_data.get('phosphorus', '不明'),
+            _pack_full_text(full_text)
+        ]
+        
+        # (value_input_option='USER_ENTERED'で=IMAGE()数式を数式として認識させる)
+        # 即フラッシュする（ワーカースレッド送信なのでリランはブロックしない。
+        # 溜め置きするとセッションが閉じた時点で記録が失われる）
+        st.session_state.setdefault('sheet_buffer', []).append(row)
+        return flush_sheet_buffer()
+    except Exception as e:
+        st.warning(f"スプレッドシートへの保存に失敗しました: {e}")
+        return False
+
+# AI応答パース用パターン（呼び出しごとに再構築せずモジュールロード時に一度コンパイル）
+_MEAL_RE = re.compile(r'料理名[：:]\s*(.+)')
+# Driveファイル名に使えない文字の除去テーブル（re.subより速いstr.translate用）
+_FORBIDDEN_FILENAME = str.maketrans('', '', '\\/*?:"<>|')
+
+# APIエラー分類テーブル（パターンは起動時に1度だけコンパイル。
+# 先頭から順に評価し、最初にマッチした案内文を表示する）
+_ERROR_HINTS = (
+    (re.compile(r'429|ResourceExhausted'),
+     "短時間に多くのリクエストを送ったため、一時的に利用が制限されています。1〜2分待ってから再試行してください。"),
+    (re.compile(r'404|NotFound'),
+     "モデル `{model}` が見つかりませんでした。APIキーが正しいか確認してください。"),
+)
+# スプレッドシートの=IMAGE("URL")数式からURLを取り出す（管理者一覧・レポートで共用）
+# 数式はセル先頭から始まるので行頭アンカー＋matchで全文走査を避ける
+_IMAGE_URL_RE = re.compile(r'=IMAGE\("([^"]+)"\)')
+
+
+def _extract_image_url(image_cell):
+    """記録セルから画像URLを取り出す（=IMAGE数式と素のURLの両対応）"""
+    if not image_cell:
+        return None
+    cell = image_cell if isinstance(image_cell, str) else str(image_cell)
+    if cell.startswith('=IMAGE('):
+        match = _IMAGE_URL_RE.match(cell)
+        return match.group(1) if match else None
+    if cell.startswith('http'):
+        return cell
+    return None
+# 各栄養素 (数値のみ)
+# 5パターンを1本の選択肢付き正規表現にまとめ、finditerの1パスで全栄養素を拾う
+# （応答テキスト全体の走査が5回→1回になる）
+# MULTILINEで行頭にアンカーし、ラベル〜数値間は有界の量指定子にすることで
+# 本文の途中に現れる「リン」「塩分」等の語を誤って拾わない・無駄に走査しない
+_NUTRITION_KEYS = ('energy', 'protein', 'salt', 'potassium', 'phosphorus')
+_COMBINED_NUTRITION_RE = re.compile(
+    r'^[ \t\-\*#]*(?:'
+    r'(?P<energy>エネルギー[^\d\n]{0,16}?([\d,\.～~\-]+))'
+    r'|(?P<protein>(?:タンパク質|たんぱく質)[^\d\n]{0,16}?([\d,\.～~\-]+))'
+    r'|(?P<salt>塩分[^\d\n]{0,16}?([\d,\.～~\-]+))'
+    r'|(?P<potassium>カリウム[^\d\n]{0,16}?([\d,\.～~\-]+))'
+    r'|(?P<phosphorus>リン[^\d\n]{0,16}?([\d,\.～~\-]+))'
+    r')',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# str.findベースの高速パス用。ラベル→数値の対応は正規表現と同一
+_NUTRITION_LABELS = {
+    'energy': ('エネルギー',),
+    'protein': ('タンパク質', 'たんぱく質'),
+    'salt': ('塩分',),
+    'potassium': ('カリウム',),
+    'phosphorus': ('リン',),
+}
+_VALUE_CHARS = frozenset('0123456789,.～~-')
+
+
+def _fast_extract(text, labels):
+    """str.find＋スライスでラベル直後の数値列を切り出す高速パス
+
+    正規表現エンジンを起動せずに済むぶん典型応答では数倍速い。
+    行頭（箇条書き記号を許容）のラベルのみ対象で、見つからなければ
+    Noneを返して正規表現フォールバックに委ねる。
+    """
+    n = len(text)
+    for label in labels:
+        start = 0
+        while True:
+            idx = text.find(label, start)
+            if idx == -1:
+                break
+            start = idx + len(label)
+            # 行頭アンカー相当: ラベル前が空白・箇条書き記号のみの行か確認
+            line_start = text.rfind('\n', 0, idx) + 1
+            if text[line_start:idx].strip(' \t-*#'):
+                continue
+            # ラベルから16文字以内（同一行）に現れる数値の先頭を探す
+            i = start
+            limit = min(n, i + 17)
+            while i < limit and text[i] != '\n' and not text[i].isdigit():
+                i += 1
+            if i >= limit or i >= n or not text[i].isdigit():
+                continue
+            j = i + 1
+            while j < n and text[j] in _VALUE_CHARS:
+                j += 1
+            return text[i:j]
+    return None
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def parse_nutrition_from_response(response_text):
+    """AI応答から栄養素を抽出（同一応答の再解析はキャッシュで返す）"""
+    nutrition = {}
+
+    # 料理名を抽出
+    meal_match = _MEAL_RE.search(response_text)
+    if meal_match:
+        nutrition['meal_name'] = meal_match.group(1).strip()
+    else:
+        nutrition['meal_name'] = '不明'
+
+    # まずstr.findの高速パスで各栄養素を拾う
+    # （正規化は正規表現パスと同一にし、どちらで抽出しても同じ値になるようにする）
+    for key, labels in _NUTRITION_LABELS.items():
+        val = _fast_extract(response_text, labels)
+        if val:
+            nutrition[key] = val.replace(',', '').replace('～', '〜').replace('~', '〜')
+
+    if len(nutrition) > len(_NUTRITION_KEYS):
+        return nutrition  # 全栄養素が揃ったので正規表現は不要
+
+    for m in _COMBINED_NUTRITION_RE.finditer(response_text):
+        key = m.lastgroup
+        if key is None or key in nutrition:
+            continue  # 最初の出現のみ採用（従来のsearchと同じ挙動）
+        val = m.group(m.lastindex + 1)  # 名前付きグループの直後が数値グループ
+        if val:
+            nutrition[key] = val.replace(',', '').replace('～', '〜').replace('~', '〜')
+        if len(nutrition) > len(_NUTRITION_KEYS):  # meal_name + 5種が揃ったら終了
+            break
+
+    for key in _NUTRITION_KEYS:
+        nutrition.setdefault(key, '不明')
+
+    return nutrition
+
+# --- 管理者モード用関数 ---
+@st.cache_resource
+def _records_store():
+    """取得済みレコードの永続ストア（差分フェッチ用）
+
+    追記しか起きないシートなので、2回目以降は前回取得済みの行数から
+    先(A{n+1}:K)だけを読めばよい。ヘッダと行リストをプロセス内で保持する。
+    """
+    return {'header': None, 'rows': [], 'row_count': 0}
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_records(spreadsheet_name="栄養管理AI"):
+    """全レコードをTTL付きでキャッシュ取得（TTL切れ時は差分のみフェッチ）
+
+    管理者モードはフィルタ操作のたびにリランするため、そのつど
+    get_all_records()のフルフェッチを打つとSheets APIが律速になる。
+    60秒以内のリランはキャッシュで返し、TTL切れや.clear()後も
+    新規行だけをシートから読み足す（全行の再転送はしない）。
+    """
+    gc = get_gspread_client()
+    if gc is None:
+        return []
+    worksheet = gc.open(spreadsheet_name).sheet1
+    store = _records_store()
+    # get_all_records()はセルごとに型推論を挟むため行数に比例して重い。
+    # 範囲を記録列(A:K)に限定したbatch_getで生の値を取り、ヘッダ行と
+    # zipするだけなら文字列のまま一瞬で済む
+    # （数値化は利用側の_parse_nutrition_series等がまとめて行う）
+    if store['header'] is None:
+        ranges = worksheet.batch_get(['A:K'])
+        values = ranges[0] if ranges else []
+        if not values:
+            return []
+        store['header'] = values[0]
+        new_rows = values[1:]
+        store['row_count'] = len(values)
+        store['rows'] = []
+    else:
+        ranges = worksheet.batch_get([f"A{store['row_count'] + 1}:K"])
+        new_rows = ranges[0] if ranges else []
+        # row_countは空行も含めた実フェッチ行数で進める。空行を数え漏らすと
+        # 次回の差分開始位置が手前にずれ、取得済みの行を重複追記してしまう
+        store['row_count'] += len(new_rows)
+
+    header = store['header']
+    width = len(header)
+    store['rows'].extend(
+        dict(zip(header, row + [''] * (width - len(row))))
+        for row in new_rows
+        if any(row)
+    )
+    return list(store['rows'])
+
+
+def _reset_records_store():
+    """差分ストアを破棄して次回フル再取得させる（シート編集・削除の反映用）"""
+    store = _records_store()
+    store['header'] = None
+    store['rows'] = []
+    store['row_count'] = 0
+    _cached_records.clear()
+    _user_list.clear()
+
+
+def get_all_records(gc, spreadsheet_name="栄養管理AI"):
+    """スプレッドシートから全データを取得"""
+    try:
+        return _cached_records(spreadsheet_name)
+    except Exception as e:
+        st.warning(f"データ取得に失敗しました: {e}")
+        return []
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _user_list(spreadsheet_name="栄養管理AI"):
+    """ユーザー名のソート済み一覧（_cached_recordsと同じTTLで追随）
+
+    フィルタ操作のリランごとに全レコードからset→sortし直さない。
+    """
+    return sorted({
+        r.get('名前', '')
+        for r in _cached_records(spreadsheet_name)
+        if r.get('名前')
+    })
+
+def get_existing_nicknames(gc, spreadsheet_name="栄養管理AI"):
+    """スプレッドシートから既存のニックネーム一覧を取得"""
+    try:
+        # 専用のフルフェッチはせず、TTLキャッシュ済みの全レコードから抽出
+        return set(_user_list(spreadsheet_name))
+    except Exception:
+        # エラー時は空のセットを返す（チェックをスキップ）
+        return set()
+
+def classify_meal_type(time_str):
+    """時刻から食事区分を判定"""
+    try:
+        # HH:MM:SS 形式を想定
+        parts = time_str.split(':')
+        hour = int(parts[0])
+        
+        if 5 <= hour < 10:
+            return "🌅 朝食"
+        elif 10 <= hour < 15:
+            return "☀️ 昼食"
+        elif 15 <= hour < 22:
+            return "🌙 夕食"
+        else:
+            return "🌃 夜食"
+    except:
+        return "❓ 不明"
+
+
+def _classify_meal_series(time_series):
+    """時刻列をまとめて食事区分にするclassify_meal_typeのSeries版
+
+    時を数値化してpd.cutの区間に割り当てるだけなので、行単位の
+    try/except+分岐より大幅に速い。区間はスカラー版と同一。
+    """
+    import pandas as pd
+    hours = pd.to_numeric(
+        time_series.astype(str).str.split(':').str[0], errors='coerce'
+    )
+    labels = pd.cut(
+        hours,
+        bins=[0, 5, 10, 15, 22, 24],
+        right=False,
+        labels=["🌃 夜食", "🌅 朝食", "☀️ 昼食", "🌙 夕食", "🌃 夜食"],
+        ordered=False,
+    )
+    labels = labels.astype(object)
+    labels[labels.isna() & hours.notna()] = "🌃 夜食"  # 区間外の時（スカラー版のelse相当）
+    return labels.where(hours.notna(), "❓ 不明")
+
+def parse_nutrition_value(value):
+    """栄養素の値を数値に変換（範囲の場合は中間値）"""
+    try:
+        if isinstance(value, (int, float)):
+            return float(value)
+        value_str = str(value).replace(',', '').replace(' ', '')
+        # 範囲表記（〜、-、~）の場合は中間値を取る
+        for sep in ['〜', '～', '~', '-']:
+            if sep in value_str:
+                parts = value_str.split(sep)
+                nums = [float(p) for p in parts if p]
+                return sum(nums) / len(nums)
+        return float(value_str)
+    except:
+        return 0.0
+
+# 範囲表記の区切り（parse_nutrition_valueのループと同じ文字集合）
+_RANGE_SEP_RE = re.compile(r'[〜～~\-]')
+
+
+def _parse_nutrition_series(series):
+    """栄養素列をまとめて数値化するparse_nutrition_valueのSeries版
+
+    文字列化→カンマ/空白除去→範囲区切りで分割→数値化して行平均、と
+    全行を列演算で処理する。レコード数が増えてもPythonレベルの
+    mapループのような行単位のオーバーヘッドがかからない。
+    """
+    import pandas as pd
+    s = series.astype(str).str.replace(',', '').str.replace(' ', '')
+    parts = s.str.split(_RANGE_SEP_RE, expand=True)
+    nums = parts.apply(pd.to_numeric, errors='coerce')
+    return nums.mean(axis=1, skipna=True).fillna(0.0)
+
+
+# --- 今日の累計栄養素表示機能 ---
+def get_today_records(gc, nickname, spreadsheet_name="栄養管理AI"):
+    """今日のデータをニックネームで抽出"""
+    try:
+        # バッファ済みの行も集計に含めるため、読み出し前にフラッシュを完了させる
+        flush_sheet_buffer(wait=True)
+        spreadsheet = gc.open(spreadsheet_name)
+        worksheet = spreadsheet.sheet1
+        records = worksheet.get_all_records()
+        
+        # 日本時間の今日の日付を取得
+        JST = timezone(timedelta(hours=9), 'JST')
+        today_str = datetime.now(JST).strftime('%Y-%m-%d')
+        
+        # ニックネームと今日の日付でフィルタ
+        today_records = [
+            r for r in records 
+            if r.get('名前') == nickname and r.get('日付') == today_str
+        ]
+        return today_records
+    except Exception as e:
+        return []
+
+def calculate_daily_totals(records):
+    """累計値を計算"""
+    totals = {
+        'energy': 0.0,
+        'protein': 0.0,
+        'salt': 0.0,
+        'potassium': 0.0,
+        'phosphorus': 0.0,
+        'meal_count': len(records)
+    }
+    
+    for record in records:
+        totals['energy'] += parse_nutrition_value(record.get('エネルギー(kcal)', 0))
+        totals['protein'] += parse_nutrition_value(record.get('たんぱく質(g)', 0))
+        totals['salt'] += parse_nutrition_value(record.get('塩分(g)', 0))
+        totals['potassium'] += parse_nutrition_value(record.get('カリウム(mg)', 0))
+        totals['phosphorus'] += parse_nutrition_value(record.get('リン(mg)', 0))
+    
+    return totals
+
+def get_nutrition_targets(user_weight=None):
+    """目標値を取得（体重設定済みの場合は個人目標）"""
+    if user_weight:
+        # 体重ベースの目標値（中央値を使用）
+        return {
+            'energy': user_weight * 32.5,  # 30-35の中央
+            'protein': user_weight * 1.05,  # 0.9-1.2の中央
+            'salt': 6.0,
+            'potassium': 2000.0,
+            'phosphorus': user_weight * 1.05 * 15  # たんぱく質 × 15
+        }
+    else:
+        # 一般的な目安値（60kg想定）
+        return {
+            'energy': 1950.0,  # 60kg × 32.5
+            'protein': 63.0,   # 60kg × 1.05
+            'salt': 6.0,
+            'potassium': 2000.0,
+            'phosphorus': 945.0  # 63 × 15
+        }
+
+def display_nutrition_progress(totals, targets):
+    """プログレスバー付きで累計を表示"""
+    # カスタムCSSでプログレスバーの色を制御
+    st.markdown("""
+    <style>
+    .nutrition-item {
+        margin-bottom: 15px;
+        padding: 10px;
+        background: #f8f9fa;
+        border-radius: 8px;
+    }
+    .nutrition-label {
+        display: flex;
+        justify-content: space-between;
+        margin-bottom: 5px;
+        font-weight: bold;
+    }
+    .progress-bar {
+        height: 20px;
+        background: #e9ecef;
+        border-radius: 10px;
+        overflow: hidden;
+    }
+    .progress-fill {
+        height: 100%;
+        border-radius: 10px;
+        transition: width 0.3s ease;
+    }
+    .progress-good { background: linear-gradient(90deg, #4CAF50, #8BC34A); }
+    .progress-warning { background: linear-gradient(90deg, #FF9800, #FFC107); }
+    .progress-danger { background: linear-gradient(90deg, #f44336, #E91E63); }
+    .status-text {
+        font-size: 0.9em;
+        margin-top: 3px;
+    }
+    .over-limit {
+        color: #C62828;
+        font-weight: bold;
+    }
+    </style>
+    """, unsafe_allow_html=True)
+    
+    # 各栄養素の表示設定
+    nutrients = [
+        ('energy', '🔥 エネルギー', 'kcal', totals['energy'], targets['energy']),
+        ('protein', '🥩 たんぱく質', 'g', totals['protein'], targets['protein']),
+        ('salt', '🧂 塩分', 'g', totals['salt'], targets['salt']),
+        ('potassium', '🍌 カリウム', 'mg', totals['potassium'], targets['potassium']),
+        ('phosphorus', '🦴 リン', 'mg', totals['phosphorus'], targets['phosphorus']),
+    ]
+    
+    for key, label, unit, current, target in nutrients:
+        percentage = min((current / target) * 100, 150) if target > 0 else 0
+        display_pct = min(percentage, 100)  # バーは100%まで
+        
+        # 色の決定
+        if percentage >= 100:
+            color_class = 'progress-danger'
+            status = '⚠️ 超過'
+        elif percentage >= 80:
+            color_class = 'progress-warning'
+            status = '注意'
+        else:
+            color_class = 'progress-good'
+            status = '良好'
+        
+        # 表示
+        over_class = 'over-limit' if percentage >= 100 else ''
+        st.markdown(f"""
+        <div class="nutrition-item">
+            <div class="nutrition-label">
+                <span>{label}</span>
+                <span class="{over_class}">{current:.1f} / {target:.0f} {unit} ({percentage:.0f}%)</span>
+            </div>
+            <div class="progress-bar">
+                <div class="progress-fill {color_class}" style="width: {display_pct}%;"></div>
+            </div>
+            <div class="status-text {over_class}">{status}</div>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    # 食事回数
+    st.markdown(f"**📝 本日の記録: {totals['meal_count']}食**")
+
+@st.cache_resource
+def _ensure_matplotlib():
+    """matplotlib一式を初回グラフ描画時にロードする
+
+    matplotlib＋日本語フォント登録はインポートだけで1秒近くかかり、
+    グラフを使わない通常利用のコールドスタートには不要。サーバ描画
+    なのでバックエンドはAggに固定する。
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    import japanize_matplotlib  # noqa: F401  日本語フォント対応
+    return plt, mdates
+
+
+def create_nutrition_chart(df, start_date=None, end_date=None):
+    """栄養推移グラフを作成（全栄養素対応・3段構成）"""
+    plt, mdates = _ensure_matplotlib()
+    # japanize_matplotlibによりフォント設定は不要
+
+    # 日付をdatetime型に変換
+    dates = [datetime.strptime(d, '%Y-%m-%d') for d in df['日付']]
+    
+    # 3段のグラフを作成
+    fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(10, 10), sharex=True)
+    
+    # --- 1段目: エネルギー ---
+    ax1.plot(dates, df['エネルギー(kcal)'], marker='o', label='エネルギー(kcal)', color='#FF9800', linewidth=2)
+    ax1.set_ylabel('エネルギー (kcal)')
+    ax1.legend(loc='upper left')
+    ax1.grid(True, linestyle='--', alpha=0.7)
+    ax1.set_title('日ごとの栄養摂取推移')
+    
+    # --- 2段目: タンパク質・塩分 (2軸) ---
+    ax2.plot(dates, df['たんぱく質(g)'], marker='s', label='たんぱく質(g)', color='#4CAF50', linewidth=2)
+    ax2.set_ylabel('たんぱく質 (g)')
+    ax2.legend(loc='upper left')
+    ax2.grid(True, linestyle='--', alpha=0.7)
+    
+    # 塩分を右軸で表示
+    ax2_right = ax2.twinx()
+    ax2_right.plot(dates, df['塩分(g)'], marker='^', label='塩分(g)', color='#F44336', linestyle='--', linewidth=2)
+    ax2_right.set_ylabel('塩分 (g)')
+    ax2_right.legend(loc='upper right')
+    
+    # --- 3段目: カリウム・リン ---
+    ax3.plot(dates, df['カリウム(mg)'], marker='v', label='カリウム(mg)', color='#9C27B0', linewidth=2)
+    ax3.plot(dates, df['リン(mg)'], marker='d', label='リン(mg)', color='#3F51B5', linewidth=2)
+    ax3.set_ylabel('ミネラル (mg)')
+    ax3.legend(loc='upper left')
+    ax3.grid(True, linestyle='--', alpha=0.7)
+    
+    # X軸のフォーマット
+    ax3.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
+    
+    # 期間指定がある場合はX軸の範囲を固定
+    if start_date and end_date:
+        # datetime型に変換して範囲を設定
+        start_dt = datetime.combine(start_date, datetime.min.time())
+        end_dt = datetime.combine(end_date, datetime.min.time())
+        ax3.set_xlim([start_dt, end_dt])
+    
+    plt.tight_layout()
+    return fig
+
+
+@st.cache_data(ttl=600, max_entries=16, show_spinner=False)
+def _chart_png(df, start_date=None, end_date=None):
+    """同一データ・期間のグラフ描画結果をPNGバイト列でキャッシュ
+
+    matplotlibの3段グラフは描画に数百msかかる。画面表示とレポート生成が
+    同じ選択条件なら1度のレンダリングを共有し、figは即クローズして
+    リランごとのfigureリークも防ぐ。
+    """
+    plt, _ = _ensure_matplotlib()
+    fig = create_nutrition_chart(df, start_date, end_date)
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=100)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+# レポート1行分のテンプレート（関数内のf-stringリテラルをロード時に1度だけ構築）
+_REPORT_ROW_TEMPLATE = """
+        <tr>
+            <td style="width: 100px;">
+                <div class="date">{date}</div>
+                <div class="meal-type">{meal_type}</div>
+                <small>{time}</small>
+            </td>
+            <td class="img-cell" style="width: 120px;">{img_tag}</td>
+            <td>
+                <div class="dish-name">{dish}</div>
+                <div class="nutrition-grid">
+                    <span class="badge energy">E: {energy}</span>
+                    <span class="badge protein">P: {protein}</span>
+                    <span class="badge salt">塩: {salt}</span>
+                    <span class="badge mineral">K: {potassium}</span>
+                    <span class="badge mineral">P: {phosphorus}</span>
+                </div>
+            </td>
+        </tr>
+        """
+
+
+def _report_row(r):
+    """レコード1件をレポートの<tr>文字列へ変換"""
+    img_src = _extract_image_url(r.get('料理写真', ''))
+    img_tag = f'<img src="{img_src}" class="meal-img">' if img_src else '<span class="no-img">画像なし</span>'
+
+    return _REPORT_ROW_TEMPLATE.format(
+        date=r.get('日付', ''),
+        meal_type=r.get('食事区分', ''),
+        time=r.get('時刻', ''),
+        img_tag=img_tag,
+        dish=r.get('料理名', '不明'),
+        energy=r.get('エネルギー(kcal)', 0),
+        protein=r.get('たんぱく質(g)', 0),
+        salt=r.get('塩分(g)', 0),
+        potassium=r.get('カリウム(mg)', 0),
+        phosphorus=r.get('リン(mg)', 0),
+    )
+
+
+def generate_html_report(user_name, start_date, end_date, summary_data, records, chart_png, doctor_comment):
+    """印刷用HTMLレポートを生成（全項目対応・印刷ボタン付き）"""
+
+    # 描画済みPNGバイト列をBase64に変換
+    chart_b64 = _b64.b64encode(chart_png).decode('ascii')
+
+    # レポート行の生成（+=の逐次連結は行数分の再割り当てになるためjoinで束ねる）
+    rows_html = ''.join(_report_row(r) for r in records)
+
+    html = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>栄養指導レポート</title>
+        <style>
+            @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;700&display=swap');
+            body {{ font-family: 'Noto Sans JP', sans-serif; color: #333; max-width: 210mm; margin: 0 auto; padding: 20px; background: white; }}
+            
+            /* 印刷ボタン */
+            .print-btn-container {{ position: fixed; top: 20px; right: 20px; z-index: 100; }}
+            .print-btn {{ background: #2196F3; color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; font-weight: bold; font-size: 16px; box-shadow: 0 2px 5px rgba(0,0,0,0.2); }}
+            .print-btn:hover {{ background: #1976D2; }}
+            
+            .header {{ display: flex; justify-content: space-between; border-bottom: 2px solid #4CAF50; padding-bottom: 10px; margin-bottom: 20px; }}
+            .title {{ font-size: 24px; font-weight: bold; color: #2E7D32; }}
+            .meta {{ text-align: right; font-size: 14px; line-height: 1.5; }}
+            
+            .section {{ margin-bottom: 25px; border: 1px solid #ddd; padding: 15px; border-radius: 8px; page-break-inside: avoid; }}
+            .section-title {{ font-size: 18px; font-weight: bold; border-left: 5px solid #FF9800; padding-left: 10px; margin-bottom: 15px; background: #FFF3E0; padding: 5px 10px; }}
+            
+            /* サマリー */
+            .summary-table {{ width: 100%; border-collapse: collapse; margin-bottom: 10px; }}
+            .summary-table th {{ background: #f5f5f5; padding: 8px; border: 1px solid #ddd; font-size: 12px; }}
+            .summary-table td {{ padding: 10px; border: 1px solid #ddd; text-align: center; font-weight: bold; font-size: 16px; }}
+            
+            .comment-box {{ background: #E8F5E9; padding: 15px; border-radius: 5px; white-space: pre-wrap; min-height: 60px; }}
+            
+            .chart-container {{ text-align: center; margin: 10px 0; }}
+            .chart-img {{ max-width: 100%; height: auto; border: 1px solid #eee; }}
+            
+            /* 食事記録テーブル */
+            table.records {{ width: 100%; border-collapse: collapse; font-size: 14px; }}
+            table.records td {{ border-bottom: 1px solid #eee; padding: 10px; vertical-align: middle; }}
+            .date {{ font-weight: bold; }}
+            .meal-type {{ font-size: 12px; color: #666; background: #eee; display: inline-block; padding: 2px 6px; border-radius: 4px; margin: 2px 0; }}
+            .dish-name {{ font-weight: bold; font-size: 16px; margin-bottom: 5px; }}
+            .meal-img {{ width: 100px; height: 100px; object-fit: cover; border-radius: 5px; border: 1px solid #ddd; }}
+            .no-img {{ display: inline-block; width: 100px; height: 100px; background: #f5f5f5; line-height: 100px; text-align: center; color: #ccc; font-size: 12px; border-radius: 5px; }}
+            
+            .nutrition-grid {{ display: flex; flex-wrap: wrap; gap: 5px; }}
+            .badge {{ display: inline-block; padding: 2px 8px; border-radius: 12px; font-size: 12px; font-family: monospace; }}
+            .badge.energy {{ background: #FFF3E0; color: #EF6C00; border: 1px solid #FFE0B2; }}
+            .badge.protein {{ background: #E8F5E9; color: #2E7D32; border: 1px solid #C8E6C9; }}
+            .badge.salt {{ background: #FFEBEE; color: #C62828; border: 1px solid #FFCDD2; font-weight: bold; }}
+            .badge.mineral {{ background: #F3E5F5; color: #6A1B9A; border: 1px solid #E1BEE7; }}
+            
+            @media print {{
+                .no-print, .print-btn-container {{ display: none !important; }}
+                body {{ padding: 0; background: white; }}
+                .section {{ border: none; padding: 0; margin-bottom: 20px; }}
+                .chart-img {{ max-width: 100%; max-height: 500px; }}
+                tr {{ page-break-inside: avoid; }}
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="print-btn-container">
+            <button class="print-btn" onclick="window.print()">🖨️ 印刷する</button>
+        </div>
+
+        <div class="header">
+            <div>
+                <div class="title">栄養指導レポート</div>
+                <div style="margin-top:10px; font-size: 18px;">患者様: <strong>{user_name} 様</strong></div>
+            </div>
+            <div class="meta">
+                作成日: {datetime.now().strftime('%Y/%m/%d')}<br>
+                対象期間: {start_date} 〜 {end_date}
+            </div>
+        </div>
+
+        <div class="section">
+            <div class="section-title">📊 期間サマリー (1日平均)</div>
+            <table class="summary-table">
+                <thead>
+                    <tr>
+                        <th>エネルギー</th>
+                        <th>たんぱく質</th>
+                        <th>塩分</th>
+                        <th>カリウム</th>
+                        <th>リン</th>
+                        <th>記録日数</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    <tr>
+                        <td>{summary_data['avg_energy']} kcal</td>
+                        <td>{summary_data['avg_protein']} g</td>
+                        <td style="color: #C62828;">{summary_data['avg_salt']} g</td>
+                        <td>{summary_data['avg_potassium']} mg</td>
+                        <td>{summary_data['avg_phosphorus']} mg</td>
+                        <td>{summary_data['day_count']} 日</td>
+                    </tr>
+                </tbody>
+            </table>
+        </div>
+        
+        <div class="section">
+            <div class="section-title">👨‍⚕️ 栄養指導コメント</div>
+            <div class="comment-box">{doctor_comment if doctor_comment else "（コメントなし）"}</div>
+        </div>
+
+        <div class="section">
+            <div class="section-title">📈 栄養摂取推移</div>
+            <div class="chart-container">
+                <img src="data:image/png;base64,{chart_b64}" class="chart-img">
+            </div>
+        </div>
+
+        <div class="section">
+            <div class="section-title">🍽️ 食事記録詳細</div>
+            <table class="records">
+                {rows_html}
+            </table>
+        </div>
+    </body>
+    </html>
+    """
+    return html
+
+
+# 同じ選択条件・コメントに対するレポートHTMLはリラン間で使い回す
+# （フォーム操作のリランごとに全レコードのHTML組み立てをやり直さない）
+_generate_html_report_cached = st.cache_data(max_entries=4, show_spinner=False)(
+    generate_html_report
+)
+
+# Custom CSS for styling
+# (モジュール定数にして、セッション初回のみフロントエンドへ送信する)
+CSS_BLOCK = """
+<style>
+    .reportview-container {
+        background: #f0f2f6;
+    }
+    .main-header {
+        font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif;
+        color: #333;
+        text-align: center;
+        padding: 1rem 0;
+        font-size: clamp(1.2rem, 5vw, 2.5rem); /* フォントサイズを少し控えめに */
+        word-break: keep-all; /* 単語の途中での改行を防ぐ */
+        overflow-wrap: break-word;
+    }
+    .stButton>button {
+        width: 100%;
+        background-color: #ff4b4b;
+        color: white;
+        border-radius: 10px;
+        height: 3em;
+        font-weight: bold;
+    }
+    .result-card {
+        background-color: white;
+        padding: 20px;
+        border-radius: 15px;
+        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+        margin-top: 20px;
+    }
+    .disclaimer {
+        font-size: 0.8em;
+        color: #666;
+        margin-top: 30px;
+        border-top: 1px solid #ddd;
+        padding-top: 10px;
+    }
+</style>
+"""
+
+DISCLAIMER_HTML = """
+<div class="disclaimer">
+    <strong>【免責事項】</strong><br>
+    本アプリによる解析結果はAIによる推定値であり、実際の栄養成分と異なる場合があります。<br>
+    あくまで日々の目安としてご利用いただき、厳密な栄養管理については医師や管理栄養士の指導に従ってください。
+</div>
+"""
+
+# 毎リラン出力するが、同一文字列なのでStreamlitのdelta比較でスキップされる
+# （セッション初回のみにするとリラン時にstyle要素ごと消えてしまう）
+st.markdown(CSS_BLOCK, unsafe_allow_html=True)
+
+st.markdown("<h1 class='main-header'>透析 栄養管理AIアプリ 🥗</h1>", unsafe_allow_html=True)
+st.markdown("<p style='text-align: center;'>食事の写真を撮るorアップロードするだけで、透析管理に必要な栄養素をAIが瞬時に解析します。</p>", unsafe_allow_html=True)
+
+# Status indicator
+if pdf_reference:
+    st.markdown("✅ **食品成分表データロード済み**: 高精度モードで動作中")
+else:
+    st.caption("ℹ️ 標準モードで動作中 (成分表PDF未検出)")
+
+
+# --- Nickname Section (with Local Storage) ---
+st.markdown("---")
+
+# Initialize gspread client
+gc = get_gspread_client()
+if gc:
+    st.markdown("✅ **スプレッドシート連携**: 有効")
+else:
+    st.caption("ℹ️ スプレッドシート連携が未設定です（結果はローカル表示のみ）")
+
+# --- Nickname Section (URLパラメータ方式) ---
+# URLから nickname パラメータを取得
+query_params = st.query_params
+url_nickname = query_params.get("nickname", None)
+
+# Initialize session state
+if 'nickname' not in st.session_state:
+    st.session_state.nickname = None
+
+# URLパラメータからニックネームを設定
+if url_nickname and not st.session_state.nickname:
+    st.session_state.nickname = url_nickname
+
+# Display nickname or input form
+if st.session_state.nickname:
+    col_nick1, col_nick2 = st.columns([3, 1])
+    with col_nick1:
+        st.markdown(f"👋 こんにちは、**{st.session_state.nickname}** さん")
+    with col_nick2:
+        if st.button("名前を変更", key="change_nickname"):
+            st.session_state.nickname = None
+            # URLパラメータをクリア
+            st.query_params.clear()
+            st.rerun()
+else:
+    st.markdown("### 👤 ニックネームを設定してください")
+    st.caption("解析結果を記録するために使用します（本名でなくてOK）")
+    st.caption("💡 設定後、表示されるURLをブックマークすると次回から自動ログインできます")
+    
+    with st.form("nickname_form"):
+        new_nickname = st.text_input("ニックネーム", placeholder="例: 田中さん")
+        submitted = st.form_submit_button("設定")
+        
+        if submitted and new_nickname:
+            # スプレッドシートで重複チェック
+            existing_nicknames = get_existing_nicknames(gc) if gc else set()
+            
+            if new_nickname in existing_nicknames:
+                st.error(f"❌ 「{new_nickname}」は既に使用されています。別のニックネームを入力してください。")
+            else:
+                st.session_state.nickname = new_nickname
+                # URLパラメータに追加（これでURLが更新される）
+                st.query_params["nickname"] = new_nickname
+                st.rerun()
+
+# --- 今日の記録確認ボタン ---
+if st.session_state.nickname and gc:
+    if st.button("📊 今日の記録を確認", key="check_today", use_container_width=True):
+        st.session_state.show_today_summary = not st.session_state.get('show_today_summary', False)
+    
+    if st.session_state.get('show_today_summary', False):
+        with st.container():
+            st.markdown("### 📊 今日の累計栄養素")
+            
+            # 今日のデータを取得
+            with st.spinner("データを読み込み中..."):
+                today_records = get_today_records(gc, st.session_state.nickname)
+            
+            if today_records:
+                # 累計を計算
+                totals = calculate_daily_totals(today_records)
+                
+                # 目標値を取得（体重設定済みの場合は個人目標）
+                targets = get_nutrition_targets(st.session_state.get('user_weight', None))
+                
+                # 体重が設定されていない場合は案内を表示
+                if not st.session_state.get('user_weight'):
+                    st.info("💡 下の「体重換算で個人目安を計算」で体重を設定すると、より正確な目標値が表示されます。")
+                
+                # プログレスバー付きで表示
+                display_nutrition_progress(totals, targets)
+                
+                # 詳細な内訳を表示
+                with st.expander("📝 本日の食事詳細"):
+                    for i, record in enumerate(today_records, 1):
+                        meal_type = classify_meal_type(record.get('時刻', ''))
+                        st.markdown(f"**{i}. {record.get('料理名', '不明')}** ({meal_type})")
+                        st.caption(f"時刻: {record.get('時刻', '')} | E: {record.get('エネルギー(kcal)', 0)}kcal, P: {record.get('たんぱく質(g)', 0)}g, 塩: {record.get('塩分(g)', 0)}g")
+            else:
+                st.info("📭 今日の記録はまだありません。食事を撮影して記録しましょう！")
+            
+            st.markdown("---")
+
+# --- サイドバー: スマホアクセス用QRコード ---
+@st.cache_resource
+def get_qr_code():
+    """ローカルIPのURLとQRコードPNGを生成
+
+    QRのPNGエンコードはリランごとに走らせるには重いので、
+    st.cache_resourceでプロセスにつき一度だけ実行する。
+    失敗時は(None, None)を返し、以降も再試行しない。
+    """
+    import qrcode  # コールドスタートを軽くするため使用時にインポート
+
+    try:
+        # gethostbynameはDNS設定次第で数秒ブロックすることがあるため、
+        # UDPソケットのconnect（パケットは送信されない）で送信元IPを取得する
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            local_ip = s.getsockname()[0]
+        finally:
+            s.close()
+        network_url = f"http://{local_ip}:8501"
+        qr = qrcode.QRCode(box_size=10, border=4)
+        qr.add_data(network_url)
+        qr.make(fit=True)
+        # SVGファクトリでレンダリング（PILのラスタ変換もPNGエンコードも不要）
+        from qrcode.image.svg import SvgPathImage
+        svg = qr.make_image(image_factory=SvgPathImage).to_string(encoding="unicode")
+        return svg, network_url
+    except Exception:
+        return None, None
+
+# --- サイドバー: 管理者機能 ---
+with st.sidebar:
+    # 同一ネットワーク内のスマホから開くためのQRコード
+    qr_svg, network_url = get_qr_code()
+    if qr_svg:
+        st.subheader("📱 スマホでアクセス")
+        st.image(qr_svg, width=200)
+        st.caption(network_url)
+        st.markdown("---")
+
+    # 前リランで投げた書き込みの結果をここで回収（失敗分はバッファへ戻る）
+    _reap_flush_futures()
+
+    # バッファに未送信の記録があれば手動でも書き込めるようにする
+    pending_rows = len(st.session_state.get('sheet_buffer', []))
+    if pending_rows:
+        if st.button(f"💾 未保存の記録を保存 ({pending_rows}件)", key="flush_sheet"):
+            if flush_sheet_buffer(wait=True):
+                st.success("保存しました")
+        st.markdown("---")
+
+    # デバッグ表示はチェックを入れたときだけ組み立てる（通常利用では
+    # 抽出データのシリアライズや全文の再レンダリングを一切行わない）
+    debug_mode = st.checkbox("🔍 デバッグ表示", value=False, key="debug_mode")
+    st.markdown("---")
+
+    st.subheader("📊 管理者機能")
+
+    # セッションステートで管理者モードを管理
+    if 'admin_mode' not in st.session_state:
+        st.session_state.admin_mode = False
+    if 'admin_authenticated' not in st.session_state:
+        st.session_state.admin_authenticated = False
+    
+    # 管理者パスワード（secrets.tomlから取得、未設定時は管理者機能を無効化）
+    admin_password = st.secrets.get("ADMIN_PASSWORD", None)
+    
+    if not admin_password:
+        st.caption("管理者機能は無効です")
+    elif st.session_state.admin_mode:
+        if st.button("🏠 通常モードに戻る", key="exit_admin"):
+            st.session_state.admin_mode = False
+            st.session_state.admin_authenticated = False
+            st.rerun()
+    else:
+        # パスワード入力フォーム
+        if not st.session_state.admin_authenticated:
+            admin_pw_input = st.text_input("🔐 管理者パスワード", type="password", key="admin_pw")
+            if st.button("📊 管理者モードを開く", key="enter_admin"):
+                if admin_pw_input == admin_password:
+                    st.session_state.admin_authenticated = True
+                    st.session_state.admin_mode = True
+                    st.rerun()
+                else:
+                    st.error("❌ パスワードが違います")
+
+# --- メインコンテンツ分岐 ---
+if st.session_state.get('admin_mode', False):
+    # ========== 管理者モード ==========
+    st.markdown("---")
+    st.markdown("## 📊 食事記録レポート（管理者モード）")
+    
+    if not gc:
+        st.error("⚠️ スプレッドシート連携が設定されていないため、管理者モードは使用できません。")
+    else:
+        # データ取得（60秒キャッシュ。最新を見たいときは明示的に再読み込み）
+        if st.button("🔄 最新データを再読み込み", key="refresh_records"):
+            # 差分では拾えないシート上の編集・削除も反映するためフル再取得
+            _reset_records_store()
+        with st.spinner("データを読み込み中..."):
+            all_records = get_all_records(gc)
+        
+        if not all_records:
+            st.warning("📭 スプレッドシートにデータがまだありません。")
+        else:
+            # ユーザー一覧を取得（ソート済みをキャッシュから）
+            users = _user_list()
+            
+            # --- フィルタUI ---
+            st.markdown("### 🔍 検索条件")
+            col_filter1, col_filter2, col_filter3 = st.columns(3)
+            
+            with col_filter1:
+                selected_user = st.selectbox("👤 ユーザー", ["全員"] + users)
+            
+            with col_filter2:
+                # 日付範囲（デフォルトは過去30日）
+                from datetime import date
+                today = date.today()
+                default_start = today - timedelta(days=30)
+                start_date = st.date_input("📅 開始日", default_start)
+            
+            with col_filter3:
+                end_date = st.date_input("📅 終了日", today)
+            
+            # --- データフィルタリング＆集計（pandasの1パス） ---
+            # フィルタ→サマリー→日次集計をレコードごとのPythonループ3回では
+            # なく、DataFrame化して数値化を1度だけ行い全集計で共有する
+            import pandas as pd
+
+            df = pd.DataFrame(all_records)
+            # 期待する列が欠けていても（旧ヘッダ・作成直後のシート等）
+            # KeyErrorにせず空文字列で埋める（dict.get相当の寛容さを保つ）
+            expected_cols = [
+                '日付', '時刻', '名前', '料理名', '料理写真',
+                'エネルギー(kcal)', 'たんぱく質(g)', '塩分(g)',
+                'カリウム(mg)', 'リン(mg)', '解析結果全文',
+            ]
+            df = df.reindex(
+                columns=df.columns.union(expected_cols, sort=False), fill_value=''
+            )
+            record_dates = pd.to_datetime(df['日付'], errors='coerce').dt.date
+            mask = record_dates.notna() & (record_dates >= start_date) & (record_dates <= end_date)
+            if selected_user != "全員":
+                mask &= df['名前'] == selected_user
+            df = df[mask].sort_values(['日付', '時刻'], kind='stable')
+            df['食事区分'] = _classify_meal_series(df['時刻'])
+
+            nutrient_cols = {
+                'energy': 'エネルギー(kcal)',
+                'protein': 'たんぱく質(g)',
+                'salt': '塩分(g)',
+                'potassium': 'カリウム(mg)',
+                'phosphorus': 'リン(mg)',
+            }
+            nums = pd.DataFrame({
+                key: _parse_nutrition_series(df[col])
+                for key, col in nutrient_cols.items()
+            })
+            nums['日付'] = df['日付'].values
+
+            filtered_records = df.to_dict('records')
+
+            st.markdown(f"**{len(filtered_records)}件** のデータが見つかりました")
+
+            if filtered_records:
+                # --- 期間サマリー ---
+                st.markdown("### 📈 期間サマリー")
+
+                # 栄養素の集計（数値化済み列の合計）
+                total_energy = nums['energy'].sum()
+                total_protein = nums['protein'].sum()
+                total_salt = nums['salt'].sum()
+                total_potassium = nums['potassium'].sum()
+                total_phosphorus = nums['phosphorus'].sum()
+
+                meal_count = len(filtered_records)
+
+                # 日数を計算
+                day_count = int(df['日付'].nunique()) or 1
+                
+                col_sum1, col_sum2, col_sum3 = st.columns(3)
+                
+                with col_sum1:
+                    st.metric("総食事回数", f"{meal_count}回")
+                    st.metric("記録日数", f"{day_count}日")
+                
+                with col_sum2:
+                    st.metric("平均エネルギー/食", f"{total_energy/meal_count:.0f} kcal" if meal_count else "0 kcal")
+                    st.metric("平均たんぱく質/食", f"{total_protein/meal_count:.1f} g" if meal_count else "0 g")
+                    st.metric("平均塩分/食", f"{total_salt/meal_count:.1f} g" if meal_count else "0 g")
+                
+                with col_sum3:
+                    st.metric("1日平均エネルギー", f"{total_energy/day_count:.0f} kcal" if day_count else "0 kcal")
+                    st.metric("1日平均たんぱく質", f"{total_protein/day_count:.1f} g" if day_count else "0 g")
+                    st.metric("1日平均塩分", f"{total_salt/day_count:.1f} g" if day_count else "0 g")
+                
+                # --- グラフ表示 ---
+                st.markdown("### 📊 日ごとの推移")
+
+                # 日ごとの集計（数値化済み列のgroupby）
+                chart_df = (
+                    nums.groupby('日付', sort=True)
+                    .sum()
+                    .reset_index()
+                    .rename(columns=nutrient_cols)
+                )
+
+                if not chart_df.empty:
+                    # Streamlitでの表示もmatplotlibを使用（統一のため）。
+                    # レンダリング済みPNGをst.imageで出すことで、同じ選択条件の
+                    # リランやレポート生成が描画をやり直さない
+                    st.image(_chart_png(chart_df, start_date, end_date), use_container_width=True)
+                
+                # --- 食事記録一覧 ---
+                st.markdown("### 🍽️ 食事記録一覧")
+
+                # 期間が長いと数百件になるため、表示は20件ずつに区切る
+                # （リランごとに全件分のexpanderを組み立てない）
+                page_size = 20
+                total_pages = (len(filtered_records) - 1) // page_size + 1
+                if total_pages > 1:
+                    page = st.number_input(
+                        f"ページ（全{total_pages}ページ・{len(filtered_records)}件）",
+                        min_value=1, max_value=total_pages, value=1, step=1,
+                        key="record_page",
+                    )
+                else:
+                    page = 1
+                page_start = (page - 1) * page_size
+
+                # 表示ページ分だけをASCII列名に付け替えてitertuplesで回す
+                # （日本語列名はnamedtuple属性にならず、dict化より属性参照が速い）
+                tuple_cols = {
+                    '日付': 'date', '時刻': 'time', '名前': 'name',
+                    '料理名': 'dish', '料理写真': 'photo', '食事区分': 'meal_type',
+                    'エネルギー(kcal)': 'energy', 'たんぱく質(g)': 'protein',
+                    '塩分(g)': 'salt', 'カリウム(mg)': 'potassium',
+                    'リン(mg)': 'phosphorus', '解析結果全文': 'full_text',
+                }
+                page_df = (
+                    df.iloc[page_start:page_start + page_size]
+                    .rename(columns=tuple_cols)
+                )
+                for record in page_df.itertuples(index=False):
+                    with st.expander(f"{record.date} {record.meal_type} - {getattr(record, 'dish', '不明') or '不明'}"):
+                        col_img, col_info = st.columns([1, 2])
+
+                        with col_img:
+                            # 画像表示（IMAGE関数からURLを抽出）
+                            img_url = _extract_image_url(getattr(record, 'photo', ''))
+                            if img_url:
+                                # loading="lazy"でexpanderを開くまでブラウザに
+                                # 画像を取得させない（全件一斉ロードを防ぐ）
+                                st.markdown(
+                                    f'<img src="{img_url}" width="150" loading="lazy">',
+                                    unsafe_allow_html=True,
+                                )
+                            else:
+                                st.caption("📷 画像なし")
+
+                        with col_info:
+                            # 1レコードにつきmarkdown要素1つ（7要素に分けると
+                            # expanderごとにフロントエンドへのdeltaが7倍になる）
+                            detail_md = (
+                                f"**ユーザー**: {getattr(record, 'name', '不明')}  \n"
+                                f"**時刻**: {getattr(record, 'time', '不明')}  \n"
+                                f"**エネルギー**: {getattr(record, 'energy', '不明')} kcal  \n"
+                                f"**たんぱく質**: {getattr(record, 'protein', '不明')} g  \n"
+                                f"**塩分**: {getattr(record, 'salt', '不明')} g  \n"
+                                f"**カリウム**: {getattr(record, 'potassium', '不明')} mg  \n"
+                                f"**リン**: {getattr(record, 'phosphorus', '不明')} mg"
+                            )
+                            # 解析全文（gz:圧縮セルは展開して表示）
+                            full_text = _unpack_full_text(getattr(record, 'full_text', ''))
+                            if full_text:
+                                detail_md += "\n\n---\n" + full_text
+                            st.markdown(detail_md)
+                
+                # --- レポート作成 ---
+                st.markdown("---")
+                st.markdown("### 🖨️ 印刷用レポート")
+                
+                with st.form("report_form"):
+                    doctor_comment = st.text_area("👨‍⚕️ 栄養指導コメント", height=100, placeholder="ここに患者様へのアドバイスを入力してください")
+                    submitted = st.form_submit_button("📄 レポートをプレビュー生成")
+                    
+                if submitted:
+                    if chart_df.empty:
+                        st.error("データがないためレポートを作成できません")
+                    else:
+                        # サマリーデータの作成
+                        summary_data = {
+                            'avg_energy': f"{total_energy/meal_count:.0f}" if meal_count else "0",
+                            'avg_protein': f"{total_protein/meal_count:.1f}" if meal_count else "0",
+                            'avg_salt': f"{total_salt/meal_count:.1f}" if meal_count else "0",
+                            'avg_potassium': f"{total_potassium/meal_count:.0f}" if meal_count else "0",
+                            'avg_phosphorus': f"{total_phosphorus/meal_count:.0f}" if meal_count else "0",
+                            'day_count': str(day_count)
+                        }
+                        
+                        # HTML生成（グラフは表示用と同じキャッシュ済みPNGを共有）
+                        report_html = _generate_html_report_cached(
+                            user_name=selected_user if selected_user != "全員" else "患者",
+                            start_date=start_date.strftime('%Y/%m/%d'),
+                            end_date=end_date.strftime('%Y/%m/%d'),
+                            summary_data=summary_data,
+                            records=filtered_records,
+                            chart_png=_chart_png(chart_df, start_date, end_date),
+                            doctor_comment=doctor_comment
+                        )
+                        
+                        st.markdown("### 📄 レポートプレビュー")
+                        st.info("以下のエリアの内容が印刷されます。ブラウザの印刷機能（Ctrl+P / Cmd+P）を使用してください。")
+                        
+                        # HTMLを表示（高さは適当に確保）
+                        st.components.v1.html(report_html, height=1200, scrolling=True)
+    
+    # 管理者モードの場合は通常モードを表示しない
+    st.stop()
+
+# --- Nutritional Guidelines Section ---
+st.markdown("### 📊 透析患者の1日栄養摂取目安")
+
+# Initialize session state for weight
+if 'user_weight' not in st.session_state:
+    st.session_state.user_weight = None
+
+# Display guidelines in a nice format
+col_guide1, col_guide2 = st.columns(2)
+
+with col_guide1:
+    st.markdown("""
+    | 栄養素 | 目安値 |
+    |--------|--------|
+    | **エネルギー** | 30〜35 kcal/kg/日 |
+    | **たんぱく質** | 0.9〜1.2 g/kg/日 |
+    | **食塩** | 6g 未満 |
+    """)
+
+with col_guide2:
+    st.markdown("""
+    | 栄養素 | 目安値 |
+    |--------|--------|
+    | **カリウム** | 2000mg 未満 |
+    | **リン** | たんぱく質(g) × 15 以下 |
+    """)
+
+@st.cache_data(show_spinner=False)
+def _personal_guidelines_md(weight):
+    """体重に基づく個人目安テーブルのmarkdownを生成（体重ごとにメモ化）
+
+    計算もf-stringも軽いが、体重が変わらない限りリランのたびに
+    同じ文字列を組み立て直す必要はない。
+    """
+    energy_min = weight * 30
+    energy_max = weight * 35
+    protein_min = weight * 0.9
+    protein_max = weight * 1.2
+    phosphorus_max = protein_max * 15
+    return f"""
+    | 栄養素 | あなたの目安値 |
+    |--------|---------------|
+    | **エネルギー** | {energy_min:.0f} 〜 {energy_max:.0f} kcal |
+    | **たんぱく質** | {protein_min:.1f} 〜 {protein_max:.1f} g |
+    | **食塩** | 6g 未満 |
+    | **カリウム** | 2000mg 未満 |
+    | **リン** | {phosphorus_max:.0f}mg 以下 |
+    """
+
+
+# Weight calculator
+if st.button("🧮 体重換算で個人目安を計算"):
+    st.session_state.show_weight_form = True
+
+if st.session_state.get('show_weight_form', False):
+    with st.form("weight_form"):
+        st.markdown("#### あなたの体重を入力してください")
+        weight_input = st.number_input("体重 (kg)", min_value=20.0, max_value=200.0, value=60.0, step=0.5)
+        submitted = st.form_submit_button("計算")
+        
+        if submitted:
+            st.session_state.user_weight = weight_input
+            st.session_state.show_weight_form = False
+            st.rerun()
+
+# Display personalized guidelines if weight is set
+if st.session_state.user_weight:
+    weight = st.session_state.user_weight
+
+    st.success(f"👤 **あなたの体重 ({weight}kg) に基づく1日の目安**")
+
+    st.markdown(_personal_guidelines_md(weight))
+    
+    if st.button("🔄 体重をリセット"):
+        st.session_state.user_weight = None
+        st.rerun()
+
+st.markdown("---")
+
+# ========== 通常モード（食事入力） ==========
+# Input Method
+st.write("---")
+input_method = st.radio("入力方法", ["カメラで撮影", "画像をアップロード"], horizontal=True, label_visibility="collapsed")
+
+image = None
+
+
+def _open_image_cached(file_obj):
+    """アップロードバッファのデコード結果をセッション内で使い回す
+
+    ウィジェット操作のリランごとにImage.openからやり直すと、同じ写真を
+    毎回デコードすることになる。生バイトのダイジェストが前回と一致する間は
+    デコード済みのPILオブジェクトをそのまま返す。
+    """
+    raw = file_obj.getvalue()
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    cached = st.session_state.get('_decoded_image')
+    if cached and cached[0] == digest:
+        return cached[1]
+    img = Image.open(BytesIO(raw))
+    img.load()  # 遅延デコードをここで済ませ、以後の.copy()を安全にする
+    st.session_state['_decoded_image'] = (digest, img)
+    return img
+
+
+col1, col2 = st.columns([1, 2])
+
+with col1:
+    if input_method == "カメラで撮影":
+        img_file_buffer = st.camera_input("食事を撮影")
+        if img_file_buffer:
+            try:
+                image = _open_image_cached(img_file_buffer)
+            except Exception as e:
+                st.error(f"画像の読み込みに失敗しました: {e}")
+    else:
+        uploaded_file = st.file_uploader("画像を選択", type=["jpg", "jpeg", "png"])
+        if uploaded_file:
+            try:
+                image = _open_image_cached(uploaded_file)
+            except Exception as e:
+                st.error(f"ファイルを開けませんでした。破損しているか、対応していない形式の可能性があります: {e}")
+
+with col2:
+    if image:
+        # プレビューは縮小版をJPEGに一度だけエンコードして渡す。PILオブジェクトを
+        # 渡すとStreamlitがリランのたびにPNGへ再エンコードしてしまう
+        preview = image.copy()
+        preview.thumbnail((512, 512))
+        preview_buf = BytesIO()
+        preview.convert("RGB").save(preview_buf, format="JPEG", quality=80)
+        st.image(preview_buf.getvalue(), caption="解析対象の画像", use_container_width=True)
+        
+        # st.write("") # Spacer
+        if st.button("栄養解析を開始"):
+            # Variables to store result outside status block
+            result_text = None
+            last_error = None
+            model_name = MODEL_NAME
+            
+            # Use st.status for a better progression UI
+            with st.status("🚀 解析プロセス起動...", expanded=True) as status:
+                try:
+                    status.write("🔍 画像データをスキャン中...")
+                    status.write("🧬 食材と栄養成分を特定中...")
+                    
+                    prompt_text = PROMPT_TEXT
+
+                    # 画像を縮小してからAPIに渡す（長辺1024pxで食事認識には十分。
+                    # アップロードバイト数と画像トークン数が数分の1になる）
+                    api_image = image.copy()
+                    api_image.thumbnail((1024, 1024), Image.LANCZOS)
+                    img_buf = BytesIO()
+                    api_image.convert("RGB").save(img_buf, format="JPEG", quality=85, optimize=True)
+
+                    # Call the model with Google Search enabled
+                    status.write(f"🤖 AIモデル ({model_name}) に接続中...")
+                    status.write("🌐 Google検索を有効化...")
+
+                    # 同一画像＋プロンプトはキャッシュヒットし、API呼び出しなしで即返る
+                    result_text = analyze_meal_image(img_buf.getvalue(), prompt_text, pdf_reference is not None)
+
+                    status.update(label="✅ 解析完了！", state="complete", expanded=False)
+                    
+                except Exception as e:
+                    last_error = e
+                    status.update(label="❌ エラー発生", state="error", expanded=False)
+            
+            # Display result OUTSIDE of st.status so it shows immediately
+            if result_text:
+                st.balloons()
+                st.markdown('<div class="result-card">', unsafe_allow_html=True)
+
+                try:
+                    st.markdown(result_text)
+
+                    # --- Log to Google Spreadsheet ---
+                    if gc and st.session_state.nickname:
+                        nutrition_data = parse_nutrition_from_response(result_text)
+                        meal_name = nutrition_data.get('meal_name', '不明')
+
+                        # --- 画像をGoogle Driveにアップロード (GAS経由) ---
+                        # ファイル名を生成（日時 + ユーザー名 + 料理名）
+                        # time.strftimeはdatetimeオブジェクトを組み立てない分軽い
+                        timestamp = time.strftime('%Y%m%d_%H%M%S')
+                        safe_meal_name = meal_name.translate(_FORBIDDEN_FILENAME)[:20]
+                        filename = f"{timestamp}_{st.session_state.nickname}_{safe_meal_name}.jpg"
+
+                        # アップロードはワーカースレッドに投げ、以降のデバッグ表示の
+                        # レンダリングと並行させる（ファイル名に料理名を含むため
+                        # 解析完了前には開始できない。URLはシート書き込み直前に回収）
+                        # 画像はGemini用に縮小・エンコード済みのJPEGを使い回す
+                        upload_future = get_executor().submit(
+                            upload_image_to_gas, img_buf.getvalue(), filename
+                        )
+
+                        # Debug: Show parsed data (サイドバーで有効化したときのみ)
+                        if st.session_state.get('debug_mode'):
+                            with st.expander("🔍 解析データデバッグ（開発用）", expanded=False):
+                                st.write("抽出されたデータ:", nutrition_data)
+                                st.write("解析テキスト全文:", result_text)
+
+                        with st.spinner("📸 画像をGoogle Driveに保存中..."):
+                            image_url = upload_future.result() or ""
+
+                        if image_url:
+                            st.success("📸 食事写真をGoogle Driveに保存しました！")
+
+                        if log_to_spreadsheet(gc, st.session_state.nickname, meal_name, nutrition_data, full_text=result_text, image_url=image_url):
+                            st.success("📊 結果をスプレッドシートに保存しました！（全文も記録しました）")
+                        else:
+                            st.info("📊 結果のスプレッドシート保存をスキップしました")
+                    elif not st.session_state.nickname:
+                        st.info("💡 ニックネームを設定すると、結果がスプレッドシートに保存されます")
+
+                except Exception as display_err:
+                    st.error(f"結果の表示中にエラーが発生しました: {display_err}")
+
+                st.markdown('</div>', unsafe_allow_html=True)
+
+            elif last_error:
+                st.error("⚠️ 解析に失敗しました")
+
+                # Friendly Error Handling（分類テーブルで振り分け）
+                err_msg = str(last_error)
+                for pattern, hint in _ERROR_HINTS:
+                    if pattern.search(err_msg):
+                        st.warning(hint.format(model=model_name))
+                        break
+                else:
+                    st.error(f"エラー詳細: {last_error}")
+            else:
+                st.warning("AIからの応答がありませんでした。")
+
+# --- まとめて解析（バッチモード） ---
+st.markdown("---")
+with st.expander("📦 まとめて解析（バッチ処理・低コスト）"):
+    st.caption("撮りためた食事写真をまとめて解析します（通常の半額。結果の反映には数分〜数時間かかります）")
+
+    batch_files = st.file_uploader(
+        "画像を複数選択", type=["jpg", "jpeg", "png"],
+        accept_multiple_files=True, key="batch_files"
+    )
+
+    if batch_files and st.button("📦 バッチ解析を開始", key="start_batch"):
+        batch_images = []
+        for bf in batch_files:
+            try:
+                batch_images.append(Image.open(bf))
+            except Exception as e:
+                st.warning(f"{bf.name} を開けませんでした: {e}")
+        if batch_images:
+            try:
+                with st.spinner("バッチジョブを送信中..."):
+                    st.session_state.batch_job_name = submit_batch_analysis(batch_images)
+                st.success("📤 バッチジョブを送信しました。「状態を確認」で進捗を確認できます。")
+            except Exception as e:
+                st.error(f"バッチ送信に失敗しました: {e}")
+
+    if st.session_state.get("batch_job_name"):
+        st.caption(f"実行中のジョブ: {st.session_state.batch_job_name}")
+        if st.button("🔄 状態を確認", key="poll_batch"):
+            try:
+                job = client.batches.get(name=st.session_state.batch_job_name)
+                state = getattr(job.state, "name", str(job.state))
+                if state == "JOB_STATE_SUCCEEDED":
+                    render_batch_results(job)
+                    del st.session_state.batch_job_name
+                elif state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+                    st.error(f"バッチジョブが失敗しました: {state}")
+                    del st.session_state.batch_job_name
+                else:
+                    st.info(f"⏳ 処理中です ({state})。時間をおいて再度確認してください。")
+            except Exception as e:
+                st.error(f"状態確認に失敗しました: {e}")
+
+# Disclaimer
+# CSS_BLOCK同様に毎リラン出力する（同一文字列なのでdelta比較でスキップされ、
+# セッション初回のみにすると次のリランで要素ごと消える）
+st.markdown(DISCLAIMER_HTML, unsafe_allow_html=True)